@@ -8,6 +8,29 @@ import random
 import datetime
 import sqlite3
 import re
+import os
+import functools
+import math
+import zlib
+import gzip
+import heapq
+import uuid
+import ast
+import operator
+from collections import OrderedDict, deque
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from event_stream import EventStreamServer
+from mqtt_broker import MQTTBroker
 
 app = Flask(__name__)
 # Use broader CORS rules to address cross-domain issues.
@@ -43,43 +66,57 @@ def preflight_water_heater_on():
 
 mqtt_client = None
 received_messages = {}
+# Broker used by the simulators. MQTT_EMBEDDED_BROKER=1 starts the in-process broker on the
+# loopback interface instead of relying on Mosquitto; with MQTT_BROKER_PORT=0 it picks a free port.
+MQTT_BROKER_HOST = os.environ.get('MQTT_BROKER_HOST', 'localhost')
+MQTT_BROKER_PORT = int(os.environ.get('MQTT_BROKER_PORT', 1884))
+MQTT_EMBEDDED_BROKER = os.environ.get('MQTT_EMBEDDED_BROKER') == '1'
+embedded_broker = None
+# Set by use_shared_state() when serve.py runs the backend as several processes.
+shared_state = None
+# Recent messages per topic kept in the shared store for /messages/<device_id>.
+SHARED_MESSAGE_HISTORY = 100
+# How often waits that other processes could end check the shared store.
+SHARED_STATE_POLL_SECONDS = 0.25
+# How often a process copies the statistics only it can compute into the shared store.
+SHARED_STATS_SECONDS = 1.0
+# Readings of the default home; the backend's ingest client is the only writer of the reading tables.
+INGEST_TOPIC = "device/+"
+# Home of the original single-home topics device/<device>; see the device registry section.
+DEFAULT_HOME_ID = 'default'
 
 
 def on_connect(client, userdata, flags, rc):
     print("Connection result: " + mqtt.connack_string(rc))
-
-
-def update_device_status(device, mode=None, status=None):
+    # API workers of serve.py only publish commands and track their acks.
+    ingest = userdata is None or userdata.get('ingest', True)
+    if ingest:
+        client.subscribe(INGEST_TOPIC)
+    # Devices acknowledge commands on device/<device>/ack.
+    client.subscribe(COMMAND_ACK_TOPIC)
+    # Devices of other homes publish under home/<home_id>/device/<device>.
+    if ingest:
+        client.subscribe(HOME_DEVICE_TOPICS)
+    # Send whatever was queued while the broker was unreachable.
+    outbound_queue.drain(client)
+
+
+def update_device_status(device, mode=None, status=None, home_id=DEFAULT_HOME_ID):
     """
     Update the status of the devices in the database and publish MQTT messages to the frontend for synchronisation.
     """
-    conn = sqlite3.connect('device_control.db')
-    cursor = conn.cursor()
-
     # Update mode
     if mode:
-        cursor.execute("UPDATE device_control SET mode = ?, last_updated = CURRENT_TIMESTAMP WHERE device = ?",
-                       (mode, device))
+        device_registry.update(device, home_id, mode=mode)
 
     # Update status
     if status:
-        cursor.execute("UPDATE device_control SET status = ?, last_updated = CURRENT_TIMESTAMP WHERE device = ?",
-                       (status, device))
+        device_registry.update(device, home_id, status=status)
 
         # Send MQTT message synchronisation
-        topic = f"device/{device}/status"
-        mqtt_client.publish(topic, status)
-        print(f"MQTT Published: {topic} -> {status}")
-
-    # Added Data Synchronisation
-    if status in ['BRIGHTER', 'DIMMER', 'OFF']:
-        cursor.execute('''
-            INSERT INTO light_control_data (intensity, status, timestamp)
-            VALUES (?, ?, ?)
-        ''', (random.uniform(100, 800), status.lower(), datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-
-    conn.commit()
-    conn.close()
+        topic = f"{device_topic(home_id, device)}/status"
+        sent = send_device_message(device, topic, status, retain=True)
+        print(f"MQTT {'Published' if sent else 'Queued'}: {topic} -> {status}")
 
 
 def on_message(client, userdata, msg):
@@ -92,49 +129,65 @@ def on_message(client, userdata, msg):
         payload_dict = json.loads(payload_str)
         topic = msg.topic
 
+        if mqtt.topic_matches_sub(COMMAND_ACK_TOPIC, topic):
+            command_tracker.acknowledge(payload_dict.get("id"), topic.split('/')[1])
+            return
+
+        # Map the topic to the inventory device it belongs to, if any.
+        home_id, device = device_registry.resolve_topic(topic) or (DEFAULT_HOME_ID, None)
+
         # Add a timestamp (if the original message was not provided)
         if 'timestamp' not in payload_dict:
             payload_dict['timestamp'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
         # Save a record of your messages.
-        if topic not in received_messages:
-            received_messages[topic] = []
-        received_messages[topic].append(payload_dict)
+        record_message(topic, payload_dict)
 
         # Handle the state of Lighting
-        if topic == "device/lighting":
+        if device == "lighting":
             command = payload_dict.get("command")
             if command == "BRIGHTER":
-                update_device_status('lighting', 'on')
-                print("[Light control] Increase brightness")
+                update_device_status('lighting', 'on', home_id=home_id)
+                print(f"[Light control] {home_id}: Increase brightness")
             elif command == "DIMMER":
-                update_device_status('lighting', 'on')
-                print("[Light control] Decrease brightness")
+                update_device_status('lighting', 'on', home_id=home_id)
+                print(f"[Light control] {home_id}: Decrease brightness")
             elif command == "OFF":
-                update_device_status('lighting', 'off')
-                print("[Light control] Turn off")
+                update_device_status('lighting', 'off', home_id=home_id)
+                print(f"[Light control] {home_id}: Turn off")
 
         # Handle the state of Water Heater
-        elif topic == "device/water_heater":
+        elif device == "water_heater":
             command = payload_dict.get("command")
             if command == "ON":
-                update_device_status('water_heater', 'on')
-                print("[Water heater control] Turn on")
+                update_device_status('water_heater', 'on', home_id=home_id)
+                print(f"[Water heater control] {home_id}: Turn on")
             elif command == "OFF":
-                update_device_status('water_heater', 'off')
-                print("[Water heater control] Turn off")
+                update_device_status('water_heater', 'off', home_id=home_id)
+                print(f"[Water heater control] {home_id}: Turn off")
+            # Readings of the default home's water heater share the topic with its commands.
+            elif command is None and home_id == DEFAULT_HOME_ID and payload_dict.get("temperature") is not None:
+                save_water_heater_to_db(payload_dict["temperature"], payload_dict.get("status"),
+                                        payload_dict["timestamp"])
 
         # Handle the state of Surveillance Camera
-        elif topic == "device/camera":
+        elif device == "camera":
             command = payload_dict.get("command")
             if command == "ON":
-                update_device_status('camera', 'on')
-                print("[Camera control] Start")
+                update_device_status('camera', 'on', home_id=home_id)
+                print(f"[Camera control] {home_id}: Start")
             elif command == "OFF":
-                update_device_status('camera', 'off')
-                print("[Camera control] Turn off")
-
-        # Process FPS and camera status data
+                update_device_status('camera', 'off', home_id=home_id)
+                print(f"[Camera control] {home_id}: Turn off")
+
+        # Process temperature, light sensor, FPS and camera status data
+        elif topic == "device/temperature":
+            if payload_dict.get("temperature") is not None:
+                save_to_db(payload_dict["temperature"], payload_dict["timestamp"])
+        elif topic == "device/light_control":
+            if payload_dict.get("intensity") is not None:
+                save_light_control_to_db(payload_dict["intensity"], payload_dict.get("status"),
+                                         payload_dict["timestamp"])
         elif topic == "device/fps":
             save_fps_to_db(payload_dict.get("fps"), payload_dict["timestamp"])
         elif topic == "device/surveillance_camera":
@@ -162,6 +215,39 @@ def on_message(client, userdata, msg):
         print(f"[Error] Message parsing failed: {e}")
 
 
+def record_message(topic, payload):
+    if shared_state is not None:
+        shared_state.append(f"messages:{topic}", payload, SHARED_MESSAGE_HISTORY)
+    else:
+        received_messages.setdefault(topic, []).append(payload)
+
+
+def recent_messages(topic, limit=None):
+    """
+    Messages received on a topic, oldest first; only the newest `limit` when given.
+    """
+    if shared_state is not None:
+        return shared_state.recent(f"messages:{topic}", limit or SHARED_MESSAGE_HISTORY)
+    msgs = received_messages.get(topic, [])
+    return msgs[-limit:] if limit else msgs
+
+
+def start_backend_client(client_id=None, ingest=True):
+    """
+    Connect the backend's MQTT client to the configured broker. With ingest it stores every reading
+    published on device/<device>, so the simulators and real devices only publish; without, it only
+    sends commands and receives their acks. Reconnects on its own.
+    """
+    global mqtt_client
+    client = mqtt.Client(client_id=client_id or f"backend-{uuid.uuid4().hex[:8]}", userdata={'ingest': ingest})
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect_async(MQTT_BROKER_HOST, MQTT_BROKER_PORT, 60)
+    client.loop_start()
+    mqtt_client = client
+    return client
+
+
 def init_device_control_db():
     """
     Initialize the device_control database with the required schema and default values.
@@ -170,9 +256,10 @@ def init_device_control_db():
     cursor = conn.cursor()
 
     # Create a table if it doesn't exist.
-    cursor.execute('''
+    cursor.execute(f'''
         CREATE TABLE IF NOT EXISTS device_control (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
+            home_id TEXT NOT NULL DEFAULT '{DEFAULT_HOME_ID}',
             device TEXT NOT NULL,
             mode TEXT NOT NULL,
             status TEXT NOT NULL,
@@ -181,8 +268,15 @@ def init_device_control_db():
         )
     ''')
 
+    # Databases created before homes existed get the column; their rows belong to the default home.
+    cursor.execute("PRAGMA table_info(device_control)")
+    if 'home_id' not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE device_control ADD COLUMN home_id TEXT NOT NULL DEFAULT '{DEFAULT_HOME_ID}'")
+        print(" Database migrated to multi-home device inventory.")
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_device_control_home_device ON device_control (home_id, device)')
+
     # Query whether data exists.
-    cursor.execute("SELECT COUNT(*) FROM device_control")
+    cursor.execute("SELECT COUNT(*) FROM device_control WHERE home_id = ?", (DEFAULT_HOME_ID,))
     count = cursor.fetchone()[0]
 
     # If there is no data, the default data is inserted.
@@ -201,58 +295,1045 @@ def init_device_control_db():
 
     conn.commit()
     conn.close()
+    device_registry.load()
 
 
+# ==================== Device registry ====================
+# Devices are keyed by (home_id, device). The original single-home topics device/<device>
+# belong to DEFAULT_HOME_ID; other homes publish on home/<home_id>/device/<device>.
 
-@app.route('/api/device/<device>/<action>', methods=['POST'])    #-----------------------------------------
-def control_device(device, action):
-    try:
-        conn = sqlite3.connect('device_control.db')
-        cursor = conn.cursor()
 
-        # Fix mappings
-        status_mapping = {
-            'brighter': 'BRIGHTER',
-            'dimmer': 'DIMMER',
-            'off': 'OFF',
-            'on': 'ON'
+def device_topic(home_id, device):
+    """
+    Base MQTT topic of a device in a home.
+    """
+    if home_id == DEFAULT_HOME_ID:
+        return f"device/{device}"
+    return f"home/{home_id}/device/{device}"
+
+
+class DeviceRegistry:
+    """
+    Authoritative in-memory copy of device_control with write-through persistence.
+
+    Reads never touch SQLite. Every update is written to device_control.db under the
+    registry lock before it becomes visible, so memory and disk change in the same order.
+    Devices are grouped per home so bulk operations only touch one home's rows, and a
+    topic index resolves an MQTT topic to its (home_id, device) with one dict lookup.
+    Safe to use from Flask request threads and the MQTT network thread. Under serve.py a
+    shared counter tells each process when another one changed device_control.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        # Long-poll waiters sleep on this until a device's control state changes.
+        self.changed = threading.Condition(self.lock)
+        self.conn = None
+        self.homes = {}
+        self.home_versions = {}
+        self.topics = {}
+        self.version = 0
+        self.store = None
+        self.store_version = None
+        self.watcher = None
+
+    def attach(self, store):
+        """
+        Share control state with the other server processes through `store`.
+        """
+        with self.lock:
+            self.store = store
+            self.store_version = None
+            # Versions continue after those this process may already have handed out.
+            seen = store.counter('devices')
+            if seen < self.version:
+                store.incr('devices', self.version - seen)
+
+    def load(self):
+        with self.lock:
+            if self.conn is None:
+                self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._reload(self.store.counter('devices') if self.store is not None else None)
+
+    def _reload(self, version=None):
+        """
+        Rebuild the in-memory copy from device_control. With a shared store every device gets the
+        shared counter as its version, so versions stay comparable between processes.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT home_id, device, mode, status, manual_override, last_updated FROM device_control")
+        self.homes, self.home_versions, self.topics = {}, {}, {}
+        for home_id, device, mode, status, manual_override, last_updated in cursor.fetchall():
+            self._add(home_id, device, {
+                'mode': mode,
+                'status': status,
+                'manual_override': manual_override,
+                'last_updated': last_updated
+            }, version)
+        if version is not None:
+            self.version = self.store_version = version
+        self.changed.notify_all()
+
+    def _add(self, home_id, device, state, version=None):
+        if version is None:
+            self.version += 1
+            version = self.version
+        state['version'] = version
+        self.homes.setdefault(home_id, {})[device] = state
+        self.home_versions[home_id] = version
+        self.topics[device_topic(home_id, device)] = (home_id, device)
+
+    def _ensure_loaded(self):
+        if self.conn is None:
+            self.load()
+        elif self.store is not None:
+            version = self.store.counter('devices')
+            if version != self.store_version:
+                self._reload(version)
+
+    def _claim_versions(self, count):
+        """
+        Make the next `count` versions the ones of this process's change. With a shared store they
+        are reserved on the shared counter.
+        """
+        if self.store is None:
+            return
+        top = self.store.incr('devices', count)
+        # If another process changed devices in between, the old mark makes the next read reload.
+        if self.store_version == top - count:
+            self.store_version = top
+        self.version = top - count
+
+    def get(self, device, home_id=DEFAULT_HOME_ID):
+        with self.lock:
+            self._ensure_loaded()
+            state = self.homes.get(home_id, {}).get(device)
+            return dict(state) if state else None
+
+    def fields(self, device, names, home_id=DEFAULT_HOME_ID):
+        """
+        Return the named fields of a device as a tuple, or None for an unknown device.
+        """
+        state = self.get(device, home_id)
+        return tuple(state[name] for name in names) if state else None
+
+    def all(self, home_id=DEFAULT_HOME_ID):
+        with self.lock:
+            self._ensure_loaded()
+            return [(device, dict(state)) for device, state in self.homes.get(home_id, {}).items()]
+
+    def home_summary(self):
+        with self.lock:
+            self._ensure_loaded()
+            return [{'home_id': home_id, 'devices': len(devices), 'version': self.home_versions[home_id]}
+                    for home_id, devices in self.homes.items()]
+
+    def resolve_topic(self, topic):
+        """
+        Return (home_id, device) for a device's base topic, or None when it is not in the inventory.
+        """
+        with self.lock:
+            self._ensure_loaded()
+            return self.topics.get(topic)
+
+    def add_devices(self, home_id, devices):
+        """
+        Register (device, mode, status) rows for a home in one transaction.
+        Devices that already exist are left unchanged. Return the names that were added.
+        """
+        with self.lock:
+            self._ensure_loaded()
+            existing = self.homes.get(home_id, {})
+            added = []
+            for device, mode, status in devices:
+                if device not in existing and device not in {row[0] for row in added}:
+                    added.append((device, mode, status))
+            last_updated = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT INTO device_control (home_id, device, mode, status, manual_override, last_updated) "
+                    "VALUES (?, ?, ?, ?, 'off', ?)",
+                    [(home_id, device, mode, status, last_updated) for device, mode, status in added])
+            if added:
+                self._claim_versions(len(added))
+            for device, mode, status in added:
+                self._add(home_id, device, {
+                    'mode': mode,
+                    'status': status,
+                    'manual_override': 'off',
+                    'last_updated': last_updated
+                })
+            self.changed.notify_all()
+            return [device for device, _, _ in added]
+
+    def update(self, device, home_id=DEFAULT_HOME_ID, **fields):
+        """
+        Change fields of one device. Return the new state, or None when the device is unknown.
+        """
+        with self.lock:
+            self._ensure_loaded()
+            devices = self.homes.get(home_id, {})
+            if device not in devices:
+                return None
+            self._persist(home_id, [(device, fields)])
+            return dict(devices[device])
+
+    def update_all(self, home_id=DEFAULT_HOME_ID, **fields):
+        """
+        Change fields of every device of one home.
+        """
+        with self.lock:
+            self._ensure_loaded()
+            self._persist(home_id, [(device, fields) for device in self.homes.get(home_id, {})])
+
+    def update_many(self, changes, home_id=DEFAULT_HOME_ID):
+        """
+        Apply a list of (device, fields) changes in a single transaction. All devices must exist.
+        """
+        with self.lock:
+            self._ensure_loaded()
+            devices = self.homes.get(home_id, {})
+            unknown = [device for device, _ in changes if device not in devices]
+            if unknown:
+                raise KeyError(f"Unknown devices: {', '.join(unknown)}")
+            self._persist(home_id, changes)
+
+    def _persist(self, home_id, changes):
+        if not changes:
+            return
+        last_updated = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        # The connection context manager commits once for the whole batch, or rolls it back.
+        with self.conn:
+            for device, fields in changes:
+                assignments = ', '.join(f"{name} = ?" for name in fields)
+                self.conn.execute(f"UPDATE device_control SET {assignments}, last_updated = ? "
+                                  f"WHERE home_id = ? AND device = ?",
+                                  tuple(fields.values()) + (last_updated, home_id, device))
+
+        self._claim_versions(len(changes))
+        devices = self.homes[home_id]
+        for device, fields in changes:
+            self.version += 1
+            devices[device].update(fields, last_updated=last_updated, version=self.version)
+        self.home_versions[home_id] = self.version
+        self.changed.notify_all()
+
+    def _device_version(self, device, home_id):
+        if device is None:
+            return self.home_versions.get(home_id, 0)
+        state = self.homes.get(home_id, {}).get(device)
+        return state['version'] if state else 0
+
+    def device_version(self, device=None, home_id=DEFAULT_HOME_ID):
+        """
+        Version of one device's control state, or of the whole home when device is None.
+        """
+        with self.lock:
+            self._ensure_loaded()
+            return self._device_version(device, home_id)
+
+    def wait_for_change(self, device, version, timeout, home_id=DEFAULT_HOME_ID):
+        """
+        Block until the device's (or its home's) version moves past `version`, or the timeout elapses.
+        """
+        with self.changed:
+            self._ensure_loaded()
+            if self.store is not None and self.watcher is None:
+                self.watcher = threading.Thread(target=self._watch, daemon=True)
+                self.watcher.start()
+            self.changed.wait_for(lambda: self._device_version(device, home_id) > version, timeout)
+            return self._device_version(device, home_id)
+
+    def _watch(self):
+        # Changes made by other processes do not notify the condition. One thread per process polls
+        # the shared counter and reloads once per change, which wakes every waiter.
+        while True:
+            time.sleep(SHARED_STATE_POLL_SECONDS)
+            if self.store.counter('devices') != self.store_version:
+                with self.lock:
+                    self._ensure_loaded()
+
+
+device_registry = DeviceRegistry('device_control.db')
+
+
+
+# ==================== Command acknowledgement tracking ====================
+# Every command is published with a correlation id on device/<device>/command as
+# {"id": ..., "action": ...}; devices answer on device/<device>/ack with {"id": ...}.
+# Pending commands sit in a dict plus a min-heap of deadlines, so acks are O(1) and
+# expiring timeouts is O(log n) per command on a single sweeper thread.
+
+COMMAND_ACK_TOPIC = "device/+/ack"
+DEVICE_COMMAND_TOPIC = "device/+/command"
+HOME_DEVICE_TOPICS = "home/+/device/+"
+COMMAND_ACK_TIMEOUT_SECONDS = 10
+# Upper bounds (ms) of the publish-to-ack latency histogram buckets; the last bucket is open-ended.
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, latency_ms):
+        index = len(LATENCY_BUCKETS_MS)
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if latency_ms <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.count += 1
+        self.total_ms += latency_ms
+        self.max_ms = max(self.max_ms, latency_ms)
+
+    def percentile(self, fraction):
+        """
+        Upper bound of the bucket holding the given fraction of samples.
+        """
+        if self.count == 0:
+            return None
+        threshold = fraction * self.count
+        running = 0
+        for i, count in enumerate(self.counts):
+            running += count
+            if running >= threshold:
+                return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else round(self.max_ms, 2)
+        return round(self.max_ms, 2)
+
+    def summary(self):
+        buckets = {f"le_{bound}": count for bound, count in zip(LATENCY_BUCKETS_MS, self.counts)}
+        buckets['inf'] = self.counts[-1]
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total_ms / self.count, 2) if self.count else None,
+            'max_ms': round(self.max_ms, 2),
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'buckets': buckets
         }
 
-        new_status = status_mapping.get(action.lower(), None)
+
+class CommandTracker:
+    """
+    Pending-command table with heap-based timeouts and per-device latency histograms.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.lock = threading.Condition()
+        self.pending = {}
+        self.deadlines = []
+        self.histograms = {}
+        self.acked = 0
+        self.timed_out = {}
+        self.unknown_acks = 0
+        self.sweeper = None
+
+    def track(self, device, action, command_id=None):
+        command_id = command_id or uuid.uuid4().hex[:16]
+        now = time.monotonic()
+        with self.lock:
+            self.pending[command_id] = {
+                'device': device,
+                'action': action,
+                'sent_at': now,
+                'timestamp': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            }
+            heapq.heappush(self.deadlines, (now + self.timeout, command_id))
+            if self.sweeper is None:
+                self.sweeper = threading.Thread(target=self._sweep, daemon=True)
+                self.sweeper.start()
+            self.lock.notify()
+        return command_id
+
+    def acknowledge(self, command_id, device):
+        with self.lock:
+            command = self.pending.pop(command_id, None)
+            if command is None:
+                # Unknown, duplicate or already timed out; its heap entry (if any) is skipped lazily.
+                self.unknown_acks += 1
+                return
+            latency_ms = (time.monotonic() - command['sent_at']) * 1000
+            self.histograms.setdefault(command['device'], LatencyHistogram()).record(latency_ms)
+            self.acked += 1
+        print(f"[Command ack] {device} {command['action']} ({command_id}) in {latency_ms:.1f} ms")
+
+    def _sweep(self):
+        with self.lock:
+            while True:
+                if not self.deadlines:
+                    self.lock.wait()
+                    continue
+                deadline, command_id = self.deadlines[0]
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self.lock.wait(remaining)
+                    continue
+                heapq.heappop(self.deadlines)
+                command = self.pending.pop(command_id, None)
+                if command is not None:
+                    self.timed_out[command['device']] = self.timed_out.get(command['device'], 0) + 1
+                    print(f"[Warning] Command {command['action']} to {command['device']} ({command_id}) was not acknowledged")
+
+    def pending_commands(self):
+        now = time.monotonic()
+        with self.lock:
+            return [{
+                'id': command_id,
+                'device': command['device'],
+                'action': command['action'],
+                'timestamp': command['timestamp'],
+                'age_ms': round((now - command['sent_at']) * 1000, 1)
+            } for command_id, command in self.pending.items()]
+
+    def latency_summary(self):
+        with self.lock:
+            devices = set(self.histograms) | set(self.timed_out)
+            return {
+                'acked': self.acked,
+                'pending': len(self.pending),
+                'unknown_acks': self.unknown_acks,
+                'devices': {device: dict(self.histograms.get(device, LatencyHistogram()).summary(),
+                                         timed_out=self.timed_out.get(device, 0))
+                            for device in devices}
+            }
+
+
+command_tracker = CommandTracker(COMMAND_ACK_TIMEOUT_SECONDS)
+
+
+@app.route('/api/commands/latency', methods=['GET'])
+def get_command_latency():
+    # Each serve.py process tracks the commands it sent.
+    if shared_state is not None:
+        return jsonify({'processes': shared_state.items('stats:commands:')})
+    return jsonify(command_tracker.latency_summary())
+
+
+@app.route('/api/commands/pending', methods=['GET'])
+def get_pending_commands():
+    return jsonify({'pending': command_tracker.pending_commands()})
+
+
+# ==================== Offline outbound queue ====================
+# Messages to devices go through send_device_message. While the broker is unreachable
+# (or older messages are still waiting) they are appended to outbound.db and drained in
+# order by on_connect. Status topics are published retained so a device that reconnects
+# receives its current state at once; a newer retained status replaces a queued older one.
+
+class OutboundQueue:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.conn = None
+        self.depth = 0
+        self.sent = 0
+        self.queued = 0
+
+    def _ensure_open(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.depth = self.conn.execute("SELECT COUNT(*) FROM outbound_queue").fetchone()[0]
+
+    def _publish(self, client, device, topic, payload, retain, command_id, action):
+        if client is None or not client.is_connected():
+            return False
+        if client.publish(topic, payload, qos=1, retain=retain).rc != mqtt.MQTT_ERR_SUCCESS:
+            return False
+        if command_id:
+            command_tracker.track(device, action, command_id)
+        self.sent += 1
+        return True
+
+    def send(self, device, topic, payload, retain=False, command_id=None, action=None):
+        """
+        Publish now if possible, otherwise persist the message. Return True when it was published.
+        """
+        with self.lock:
+            self._ensure_open()
+            if self.depth == 0 and self._publish(mqtt_client, device, topic, payload, retain, command_id, action):
+                return True
+            with self.conn:
+                if retain:
+                    # Only the newest retained state of a topic matters to a reconnecting device.
+                    self.depth -= self.conn.execute(
+                        "DELETE FROM outbound_queue WHERE topic = ? AND retain = 1", (topic,)).rowcount
+                self.conn.execute(
+                    "INSERT INTO outbound_queue (device, topic, payload, retain, command_id, action, enqueued_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (device, topic, payload, int(retain), command_id, action, time.time()))
+            self.depth += 1
+            self.queued += 1
+            if mqtt_client is not None and mqtt_client.is_connected():
+                self.drain(mqtt_client)
+            return False
+
+    def drain(self, client):
+        """
+        Publish queued messages in order until the queue is empty or publishing fails.
+        """
+        with self.lock:
+            self._ensure_open()
+            if self.depth == 0:
+                return 0
+            rows = self.conn.execute("SELECT id, device, topic, payload, retain, command_id, action "
+                                     "FROM outbound_queue ORDER BY id").fetchall()
+            sent_ids = []
+            for row_id, device, topic, payload, retain, command_id, action in rows:
+                if not self._publish(client, device, topic, payload, bool(retain), command_id, action):
+                    break
+                sent_ids.append((row_id,))
+            with self.conn:
+                self.conn.executemany("DELETE FROM outbound_queue WHERE id = ?", sent_ids)
+            self.depth -= len(sent_ids)
+            print(f"[Outbound queue] Drained {len(sent_ids)} messages, {self.depth} left")
+            return len(sent_ids)
+
+    def stats(self):
+        with self.lock:
+            self._ensure_open()
+            now = time.time()
+            devices = {device: {'depth': count, 'oldest_age_seconds': round(now - oldest, 1)}
+                       for device, count, oldest in self.conn.execute(
+                           "SELECT device, COUNT(*), MIN(enqueued_at) FROM outbound_queue GROUP BY device")}
+            return {'depth': self.depth, 'sent': self.sent, 'queued': self.queued, 'devices': devices}
+
+
+outbound_queue = OutboundQueue('outbound.db')
+
+
+def send_device_message(device, topic, payload, retain=False, command_id=None, action=None):
+    """
+    Deliver a message to a device now or, while the broker is unreachable, once it reconnects.
+    Return True when it was published immediately.
+    """
+    return outbound_queue.send(device, topic, payload, retain, command_id, action)
+
+
+@app.route('/api/commands/queue', methods=['GET'])
+def get_outbound_queue():
+    return jsonify(outbound_queue.stats())
+
+
+# Fix mappings
+STATUS_MAPPING = {
+    'brighter': 'BRIGHTER',
+    'dimmer': 'DIMMER',
+    'off': 'OFF',
+    'on': 'ON'
+}
+# Statuses a device accepts besides STATUS_MAPPING (the dashboard saves these through save-state).
+DEVICE_STATUSES = {
+    'aircon': ('COOLING_ON', 'COOLING_OFF', 'DEHUMIDIFYING_ON', 'DEHUMIDIFYING_OFF')
+}
+MAX_BATCH_COMMANDS = 500
+
+
+def publish_device_status(device, status, steps=None):
+    """
+    Publish the MQTT synchronisation message and the tracked command for a device status change.
+    `steps` is set when a burst of BRIGHTER/DIMMER clicks was merged into one command.
+    Messages are queued while MQTT is not connected. Return the command's correlation id.
+    """
+    topic = f"device/{device}/status"
+    command_id = uuid.uuid4().hex[:16]
+    command = {'id': command_id, 'action': status}
+    if steps is not None:
+        command['steps'] = steps
+    sent = send_device_message(device, topic, status, retain=True)
+    send_device_message(device, f"device/{device}/command", json.dumps(command), command_id=command_id, action=status)
+    print(f"[MQTT] {'Published' if sent else 'Queued'}: {topic} -> {status}" + (f" x{steps}" if steps is not None else ""))
+    return command_id
+
+
+def execute_device_commands(commands, manual=True, steps=None):
+    """
+    Apply validated (device, status) commands in one transaction, then publish them in one burst.
+    Commands issued by automation pass manual=False and leave manual_override untouched.
+    Open BRIGHTER/DIMMER bursts of the devices are applied first, so they cannot land after
+    these commands. Return the correlation id of each command.
+    """
+    if steps is None:
+        for device in {device for device, _ in commands}:
+            command_coalescer.flush(device)
+    fields = {'manual_override': 'on'} if manual else {}
+    device_registry.update_many([(device, dict(fields, status=status)) for device, status in commands])
+    return [publish_device_status(device, status, steps) for device, status in commands]
+
+
+# ==================== Command coalescing ====================
+# Repeated BRIGHTER/DIMMER clicks within a window are summed per device and applied as one
+# net command ("BRIGHTER x5"), so an interaction storm costs one write and one publish.
+# The window starts at the first click of a burst, which bounds the added latency.
+
+COMMAND_COALESCE_WINDOW_SECONDS = 0.5
+COALESCED_STEPS = {'BRIGHTER': 1, 'DIMMER': -1}
+
+
+class CommandCoalescer:
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.Condition()
+        self.pending = {}
+        self.deadlines = []
+        self.thread = None
+        self.received = 0
+        self.issued = 0
+
+    def add(self, device, step):
+        """
+        Add a step to the device's open burst and return the burst's net steps so far.
+        """
+        with self.lock:
+            self.received += 1
+        if self.window <= 0:
+            self._issue(device, step)
+            return step
+        with self.lock:
+            if device in self.pending:
+                self.pending[device] += step
+                return self.pending[device]
+            self.pending[device] = step
+            heapq.heappush(self.deadlines, (time.monotonic() + self.window, device))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.lock.notify()
+            return step
+
+    def flush(self, device):
+        """
+        Apply a device's open burst now, e.g. before an ON/OFF command so ordering is kept.
+        """
+        with self.lock:
+            steps = self.pending.pop(device, None)
+            if steps is not None:
+                # Drop the burst's deadline so it cannot cut the device's next burst short.
+                self.deadlines = [deadline for deadline in self.deadlines if deadline[1] != device]
+                heapq.heapify(self.deadlines)
+        if steps:
+            self._issue(device, steps)
+
+    def _issue(self, device, steps):
+        if steps == 0:
+            print(f"[Coalesce] {device} burst cancelled out, nothing sent")
+            return
+        with self.lock:
+            self.issued += 1
+        execute_device_commands([(device, 'BRIGHTER' if steps > 0 else 'DIMMER')], steps=abs(steps))
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while True:
+                    if not self.deadlines:
+                        self.lock.wait()
+                        continue
+                    remaining = self.deadlines[0][0] - time.monotonic()
+                    if remaining > 0:
+                        self.lock.wait(remaining)
+                        continue
+                    device = heapq.heappop(self.deadlines)[1]
+                    steps = self.pending.pop(device)
+                    break
+            try:
+                self._issue(device, steps)
+            except Exception as e:
+                print(f"[Error] Failed to apply coalesced commands for {device}: {str(e)}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                'window_seconds': self.window,
+                'received': self.received,
+                'issued': self.issued,
+                'pending': dict(self.pending)
+            }
+
+
+command_coalescer = CommandCoalescer(COMMAND_COALESCE_WINDOW_SECONDS)
+
+
+@app.route('/api/commands/coalescing', methods=['GET'])
+def get_command_coalescing():
+    return jsonify(command_coalescer.stats())
+
+
+@app.route('/api/device/<device>/<action>', methods=['POST'])    #-----------------------------------------
+def control_device(device, action):
+    try:
+        new_status = STATUS_MAPPING.get(action.lower(), None)
         if not new_status:
-            conn.close()
             return jsonify({"error": "Invalid action"}), 400
 
         # Update the database status
-        cursor.execute('''
-            UPDATE device_control
-            SET status = ?, manual_override = ?
-            WHERE device = ?
-        ''', (new_status, 'on', device))
-
-        if cursor.rowcount == 0:
-            conn.close()
+        if device_registry.get(device) is None:
             print(f"[Error] Update failed for device '{device}'")
             return jsonify({"error": f"Update failed for device '{device}'"}), 500
 
-        conn.commit()
-        conn.close()
+        if new_status in COALESCED_STEPS:
+            pending_steps = command_coalescer.add(device, COALESCED_STEPS[new_status])
+            return jsonify({"status": "success", "action": new_status, "coalesced": True,
+                            "pending_steps": pending_steps}), 200
 
-        # Publish MQTT synchronisation messages
-        topic = f"device/{device}/status"
-        if mqtt_client:
-            mqtt_client.publish(topic, new_status)
-            print(f"[MQTT] Published: {topic} -> {new_status}")
-        else:
-            print("[Warning] MQTT Client is not connected.")
+        command_id = execute_device_commands([(device, new_status)])[0]
 
-        return jsonify({"status": "success", "action": new_status}), 200
+        return jsonify({"status": "success", "action": new_status, "command_id": command_id}), 200
 
     except Exception as e:
         print(f"[Error] Failed to control {device}: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
 
+def validate_device_commands(commands):
+    """
+    Check a list of {"device": ..., "action": ...} commands.
+    Return per-command results and the (device, status) pairs that are valid.
+    """
+    results = []
+    valid = []
+    for command in commands:
+        device = command.get('device') if isinstance(command, dict) else None
+        action = command.get('action') if isinstance(command, dict) else None
+        new_status = STATUS_MAPPING.get(action.lower()) if isinstance(action, str) else None
+        if not new_status:
+            results.append({"device": device, "action": action, "status": "error", "error": "Invalid action"})
+        elif not isinstance(device, str):
+            results.append({"device": device, "action": action, "status": "error", "error": "Device must be a string"})
+        elif device_registry.get(device) is None:
+            results.append({"device": device, "action": action, "status": "error",
+                            "error": f"Unknown device '{device}'"})
+        else:
+            results.append({"device": device, "action": new_status, "status": "success"})
+            valid.append((device, new_status))
+    return results, valid
+
+
+@app.route('/api/devices/commands', methods=['POST'])
+def control_devices_batch():
+    """
+    Apply a list of {"device": ..., "action": ...} commands atomically: all are validated first,
+    persisted in one transaction and published together. Nothing is applied if any command is invalid.
+    """
+    data = request.get_json(silent=True)
+    commands = data.get('commands') if isinstance(data, dict) else data
+    if not isinstance(commands, list) or not commands:
+        return jsonify({"error": "Expected a non-empty list of commands"}), 400
+    if len(commands) > MAX_BATCH_COMMANDS:
+        return jsonify({"error": f"At most {MAX_BATCH_COMMANDS} commands per batch"}), 400
+
+    results, valid = validate_device_commands(commands)
+    if len(valid) != len(commands):
+        for result in results:
+            if result["status"] == "success":
+                result["status"] = "skipped"
+        return jsonify({"status": "error", "results": results}), 400
+
+    try:
+        command_ids = execute_device_commands(valid)
+    except Exception as e:
+        print(f"[Error] Failed to apply command batch: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+    for result, command_id in zip(results, command_ids):
+        result["command_id"] = command_id
+    print(f"[Batch control] Applied {len(valid)} commands")
+    return jsonify({"status": "success", "results": results}), 200
+
+
+# ==================== Scheduled device actions ====================
+# A schedule is a scene: a list of commands fired together through execute_device_commands,
+# either once at a given datetime or at HH:MM on a set of weekdays. All schedules share one
+# min-heap of next fire times and one thread, so adding or firing a schedule is O(log n).
+
+WEEKDAY_NAMES = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+WEEKDAY_PRESETS = {
+    'daily': (0, 1, 2, 3, 4, 5, 6),
+    'weekdays': (0, 1, 2, 3, 4),
+    'weekends': (5, 6)
+}
+
+
+def parse_weekdays(days):
+    """
+    Turn "weekdays", "mon,wed,fri" or ["sat", "sun"] into a sorted tuple of weekday numbers.
+    """
+    if days is None:
+        return WEEKDAY_PRESETS['daily']
+    if isinstance(days, str):
+        if days.lower() in WEEKDAY_PRESETS:
+            return WEEKDAY_PRESETS[days.lower()]
+        days = days.split(',')
+    elif not isinstance(days, list):
+        raise ValueError(f"Invalid days '{days}'")
+    try:
+        numbers = {WEEKDAY_NAMES.index(str(day).strip().lower()[:3]) for day in days}
+    except ValueError:
+        raise ValueError(f"Invalid days '{days}'")
+    if not numbers:
+        raise ValueError("At least one weekday is required")
+    return tuple(sorted(numbers))
+
+
+def next_fire_time(schedule, now):
+    """
+    Epoch seconds of the next firing strictly after `now`, or None when a one-shot schedule has fired.
+    """
+    if schedule['run_at']:
+        if schedule['last_fired']:
+            return None
+        return datetime.datetime.strptime(schedule['run_at'], "%Y-%m-%d %H:%M:%S").timestamp()
+
+    hour, minute = map(int, schedule['at_time'].split(':'))
+    current = datetime.datetime.fromtimestamp(now)
+    for offset in range(8):
+        candidate = (current + datetime.timedelta(days=offset)).replace(hour=hour, minute=minute,
+                                                                        second=0, microsecond=0)
+        if candidate.weekday() in schedule['days'] and candidate.timestamp() > now:
+            return candidate.timestamp()
+    return None
+
+
+class DeviceScheduler:
+    """
+    Persisted device schedules driven by a heap of (next fire time, schedule id).
+
+    Removed or rescheduled entries are left in the heap and skipped when they reach the top.
+    Under serve.py only the ingest process fires schedules; API workers load them without
+    running, and a shared counter makes every process reload after another one changed them.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Condition()
+        self.conn = None
+        self.schedules = {}
+        self.heap = []
+        self.thread = None
+        self.store = None
+        self.store_version = 0
+
+    def attach(self, store):
+        with self.lock:
+            self.store = store
+            self.store_version = store.counter('schedules')
+
+    def start(self, run=True):
+        with self.lock:
+            self._open()
+            if run and self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _open(self):
+        # add/remove/list may come before start(), e.g. from a process that never runs schedules.
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._load()
+            print(f"[Scheduler] Loaded {len(self.schedules)} schedules")
+
+    def _load(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT id, name, commands, at_time, days, run_at, last_fired FROM schedule_data")
+        now = time.time()
+        previous = self.schedules
+        self.schedules, self.heap = {}, []
+        for schedule_id, name, commands, at_time, days, run_at, last_fired in cursor.fetchall():
+            schedule = {
+                'id': schedule_id,
+                'name': name,
+                'commands': json.loads(commands),
+                'at_time': at_time,
+                'days': tuple(int(day) for day in days.split(',')) if days else (),
+                'run_at': run_at,
+                'last_fired': last_fired
+            }
+            known = previous.get(schedule_id)
+            if known is not None and known['last_fired'] == last_fired:
+                # A reload must not skip a firing that is due but not yet handled.
+                schedule['next_fire'] = known['next_fire']
+            else:
+                # One-shot schedules missed while the backend was down fire as soon as it starts.
+                schedule['next_fire'] = next_fire_time(schedule, now)
+            self.schedules[schedule_id] = schedule
+            if schedule['next_fire'] is not None:
+                self.heap.append((schedule['next_fire'], schedule_id))
+        heapq.heapify(self.heap)
+        self.lock.notify()
+
+    def _sync(self):
+        """
+        Reload the schedules when another server process changed them.
+        """
+        if self.store is None:
+            return
+        version = self.store.counter('schedules')
+        if version != self.store_version:
+            self.store_version = version
+            self._load()
+
+    def _changed(self):
+        if self.store is None:
+            return
+        version = self.store.incr('schedules')
+        if version == self.store_version + 1:
+            self.store_version = version
+
+    def add(self, name, commands, at_time=None, days=(), run_at=None):
+        with self.lock:
+            self._open()
+            self._sync()
+            schedule = {
+                'name': name,
+                'commands': commands,
+                'at_time': at_time,
+                'days': tuple(days),
+                'run_at': run_at,
+                'last_fired': None
+            }
+            with self.conn:
+                cursor = self.conn.execute(
+                    "INSERT INTO schedule_data (name, commands, at_time, days, run_at) VALUES (?, ?, ?, ?, ?)",
+                    (name, json.dumps(commands), at_time, ','.join(map(str, schedule['days'])), run_at))
+            self._changed()
+            schedule['id'] = cursor.lastrowid
+            schedule['next_fire'] = next_fire_time(schedule, time.time())
+            self.schedules[schedule['id']] = schedule
+            if schedule['next_fire'] is not None:
+                heapq.heappush(self.heap, (schedule['next_fire'], schedule['id']))
+                self.lock.notify()
+            return self._describe(schedule)
+
+    def remove(self, schedule_id):
+        with self.lock:
+            self._open()
+            self._sync()
+            if self.schedules.pop(schedule_id, None) is None:
+                return False
+            with self.conn:
+                self.conn.execute("DELETE FROM schedule_data WHERE id = ?", (schedule_id,))
+            self._changed()
+            return True
+
+    def list(self):
+        with self.lock:
+            self._open()
+            self._sync()
+            return [self._describe(schedule) for schedule in self.schedules.values()]
+
+    def _describe(self, schedule):
+        description = {key: value for key, value in schedule.items() if key != 'next_fire'}
+        description['days'] = [WEEKDAY_NAMES[day] for day in schedule['days']]
+        description['next_run'] = (datetime.datetime.fromtimestamp(schedule['next_fire']).strftime("%Y-%m-%d %H:%M:%S")
+                                   if schedule['next_fire'] is not None else None)
+        return description
+
+    def _run(self):
+        while True:
+            # With a shared store, waits are sliced so schedules added by API workers are picked up.
+            poll = SHARED_STATE_POLL_SECONDS * 4 if self.store is not None else None
+            with self.lock:
+                while True:
+                    self._sync()
+                    if not self.heap:
+                        self.lock.wait(poll)
+                        continue
+                    fire_at, schedule_id = self.heap[0]
+                    schedule = self.schedules.get(schedule_id)
+                    if schedule is None or schedule['next_fire'] != fire_at:
+                        heapq.heappop(self.heap)
+                        continue
+                    remaining = fire_at - time.time()
+                    if remaining > 0:
+                        self.lock.wait(min(remaining, poll) if poll else remaining)
+                        continue
+                    heapq.heappop(self.heap)
+                    break
+
+                schedule['last_fired'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                schedule['next_fire'] = next_fire_time(schedule, max(time.time(), fire_at))
+                if schedule['next_fire'] is not None:
+                    heapq.heappush(self.heap, (schedule['next_fire'], schedule_id))
+                with self.conn:
+                    self.conn.execute("UPDATE schedule_data SET last_fired = ? WHERE id = ?",
+                                      (schedule['last_fired'], schedule_id))
+                self._changed()
+                commands = [(command['device'], command['action']) for command in schedule['commands']]
+
+            # Fire outside the scheduler lock so a slow broker does not delay add/remove calls.
+            # Like rules, schedules are automation and leave manual_override as it is.
+            try:
+                execute_device_commands(commands, manual=False)
+                print(f"[Scheduler] Fired schedule {schedule_id} ({schedule['name']}): {commands}")
+            except Exception as e:
+                print(f"[Error] Schedule {schedule_id} failed: {str(e)}")
+
+
+device_scheduler = DeviceScheduler('schedules.db')
+
+
+@app.route('/api/schedules', methods=['GET'])
+def get_schedules():
+    return jsonify({"schedules": device_scheduler.list()})
+
+
+@app.route('/api/schedules', methods=['POST'])
+def create_schedule():
+    """
+    Create a schedule, e.g. {"device": "water_heater", "action": "on", "time": "06:30", "days": "weekdays"}
+    or a one-shot scene {"name": "away", "commands": [...], "at": "2025-01-01 08:00"}.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Expected a JSON object"}), 400
+
+    commands = data.get('commands') or [{"device": data.get('device'), "action": data.get('action')}]
+    if not isinstance(commands, list) or len(commands) > MAX_BATCH_COMMANDS:
+        return jsonify({"error": f"Expected a list of at most {MAX_BATCH_COMMANDS} commands"}), 400
+    results, valid = validate_device_commands(commands)
+    if len(valid) != len(commands):
+        return jsonify({"status": "error", "results": results}), 400
+
+    try:
+        if data.get('at'):
+            if not isinstance(data['at'], str):
+                raise ValueError("'at' must be a 'YYYY-MM-DD HH:MM' string")
+            run_at = datetime.datetime.strptime(data['at'], "%Y-%m-%d %H:%M")
+            if run_at <= datetime.datetime.now():
+                return jsonify({"error": "'at' must be in the future"}), 400
+            run_at = run_at.strftime("%Y-%m-%d %H:%M:%S")
+            at_time, days = None, ()
+        elif data.get('time'):
+            if not isinstance(data['time'], str):
+                raise ValueError("'time' must be an 'HH:MM' string")
+            at_time = datetime.datetime.strptime(data['time'], "%H:%M").strftime("%H:%M")
+            days = parse_weekdays(data.get('days'))
+            run_at = None
+        else:
+            return jsonify({"error": "Either 'time' (HH:MM) or 'at' (YYYY-MM-DD HH:MM) is required"}), 400
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    name = data.get('name') or ', '.join(f"{device} {status}" for device, status in valid)
+    schedule = device_scheduler.add(name, [{"device": device, "action": status} for device, status in valid],
+                                    at_time=at_time, days=days, run_at=run_at)
+    print(f"[Scheduler] Added schedule {schedule['id']} ({name}), next run {schedule['next_run']}")
+    return jsonify({"status": "success", "schedule": schedule}), 201
+
+
+@app.route('/api/schedules/<int:schedule_id>', methods=['DELETE'])
+def delete_schedule(schedule_id):
+    if not device_scheduler.remove(schedule_id):
+        return jsonify({"error": "Schedule not found"}), 404
+    return jsonify({"status": "success"}), 200
+
+
 def init_db():
     conn = sqlite3.connect('temperature.db')
     cursor = conn.cursor()
@@ -361,12 +1442,1106 @@ def init_surveillance_camera_db():
     conn.close()
 
 
+def init_alert_db():
+    conn = sqlite3.connect('alerts.db')
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS alert_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device TEXT NOT NULL,
+            field TEXT NOT NULL,
+            state TEXT NOT NULL,
+            value REAL,
+            zscore REAL,
+            timestamp TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_alert_device_time ON alert_data (device, timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_alert_time ON alert_data (timestamp)')
+    conn.commit()
+    conn.close()
+
+
+def init_outbound_db(db_path='outbound.db'):
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outbound_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device TEXT NOT NULL,
+            topic TEXT NOT NULL,
+            payload TEXT,
+            retain INTEGER DEFAULT 0,
+            command_id TEXT,
+            action TEXT,
+            enqueued_at REAL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbound_topic ON outbound_queue (topic)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbound_device ON outbound_queue (device)')
+    conn.commit()
+    conn.close()
+
+
+def init_schedule_db():
+    conn = sqlite3.connect('schedules.db')
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schedule_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            commands TEXT NOT NULL,
+            at_time TEXT,
+            days TEXT,
+            run_at TEXT,
+            last_fired TEXT
+        )
+    ''')
+    conn.commit()
+    conn.close()
+
+
+# ==================== Change tracking for conditional GET ====================
+# Every write path bumps an in-memory version counter for the table it touched.
+# Read endpoints derive their ETag from that counter, so a poll that finds no new
+# rows can be answered with 304 Not Modified without opening the database.
+
+SERVER_BOOT_ID = format(int(time.time() * 1000), 'x')
+SERVER_START_TIME = time.time()
+table_versions = {}
+table_last_modified = {}
+table_versions_lock = threading.Lock()
+
+
+def bump_table_version(table):
+    """
+    Record that new rows landed in a table, invalidating the ETags derived from it.
+    """
+    if shared_state is not None:
+        shared_state.set(f"table_modified:{table}", time.time())
+        shared_state.incr(f"table:{table}")
+    else:
+        with table_versions_lock:
+            table_versions[table] = table_versions.get(table, 0) + 1
+            table_last_modified[table] = time.time()
+    history_cache.invalidate(table)
+
+
+def get_table_version(table):
+    if shared_state is not None:
+        return (shared_state.counter(f"table:{table}"),
+                shared_state.get(f"table_modified:{table}", SERVER_START_TIME))
+    return table_versions.get(table, 0), table_last_modified.get(table, SERVER_START_TIME)
+
+
+def revalidate(table):
+    """
+    Return (etag, last_modified, not_modified) for the current request against the table version.
+    """
+    version, last_modified = get_table_version(table)
+    mimetype, encoding = negotiate_representation()
+    variant = zlib.crc32(request.query_string + f"|{mimetype}|{encoding}".encode())
+    # The boot id keeps ETags from a previous server run from matching after a restart.
+    etag = f"{table}-{SERVER_BOOT_ID}-{version}-{variant:x}"
+
+    not_modified = False
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    elif request.if_modified_since:
+        not_modified = int(last_modified) <= request.if_modified_since.timestamp()
+    return etag, last_modified, not_modified
+
+
+def set_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.vary.update(('Accept', 'Accept-Encoding'))
+    # Browsers must revalidate on every poll, which is what makes the 304 path useful.
+    response.cache_control.no_cache = True
+    return response
+
+
+def conditional_get(table):
+    """
+    Answer GET requests with 304 when the client's ETag or Last-Modified still matches the table version.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            etag, last_modified, not_modified = revalidate(table)
+            if not_modified:
+                response = app.response_class(status=304)
+            else:
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            return set_validators(response, etag, last_modified)
+
+        wrapper.conditional_table = table
+        return wrapper
+
+    return decorator
+
+
+# ==================== Response cache for history queries ====================
+
+HISTORY_CACHE_MAX_ENTRIES = 256
+
+
+class ResponseCache:
+    """
+    Size-bounded LRU cache of serialized responses, invalidated per table by the write path.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.keys_by_table = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, version, count_miss=True):
+        with self.lock:
+            entry = self.entries.get(key)
+            # Writes made by another server process never call invalidate() here.
+            if entry is not None and entry[1] != version:
+                del self.entries[key]
+                self.keys_by_table[entry[0]].discard(key)
+                self.invalidations += 1
+                entry = None
+            if entry is None:
+                self.misses += count_miss
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, table, version, body, mimetype, encoding):
+        with self.lock:
+            # A write that landed while the query ran makes this body stale before it is stored.
+            if get_table_version(table)[0] != version:
+                return
+            self.entries[key] = (table, version, body, mimetype, encoding)
+            self.entries.move_to_end(key)
+            self.keys_by_table.setdefault(table, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                old_key, (old_table, _, _, _, _) = self.entries.popitem(last=False)
+                self.keys_by_table[old_table].discard(old_key)
+                self.evictions += 1
+
+    def invalidate(self, table):
+        with self.lock:
+            for key in self.keys_by_table.pop(table, ()):
+                if self.entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+
+history_cache = ResponseCache(HISTORY_CACHE_MAX_ENTRIES)
+
+
+def lookup_cached_response(table, count_miss=True):
+    """
+    Return (key, version, response) for the current request; response is None on a cache miss.
+    """
+    key = (request.path, tuple(sorted(request.args.items(multi=True))), negotiate_representation())
+    version = get_table_version(table)[0]
+    entry = history_cache.get(key, version, count_miss)
+    if entry is None:
+        return key, version, None
+    _, _, body, mimetype, encoding = entry
+    response = app.response_class(body, mimetype=mimetype)
+    if encoding:
+        response.content_encoding = encoding
+        response.vary.add('Accept-Encoding')
+    return key, version, response
+
+
+def cached_response(table):
+    """
+    Serve a GET route from history_cache, keyed by path, query parameters and negotiated representation.
+    Bodies are cached after compression so a hit costs neither a query nor an encode.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key, version, response = lookup_cached_response(table)
+            if response is not None:
+                return response
+
+            response = compress_response(app.make_response(view(*args, **kwargs)))
+            if response.status_code == 200:
+                history_cache.put(key, table, version, response.get_data(), response.mimetype,
+                                  response.content_encoding)
+            return response
+
+        wrapper.cached_table = table
+        return wrapper
+
+    return decorator
+
+
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify({'history': history_cache.stats()})
+
+
+# ==================== Negotiated response formats ====================
+# History responses default to the original list-of-dicts JSON. Clients can opt into
+# ?shape=columnar ({"t": [...], "v": [...]}) and into MessagePack through the Accept
+# header; large bodies are gzip/brotli compressed when Accept-Encoding allows it.
+
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+COMPRESS_MIN_BYTES = 1024
+
+
+def negotiate_representation():
+    """
+    Return the (mimetype, content encoding) this request will be answered with.
+    """
+    mimetype = 'application/json'
+    if msgpack is not None:
+        best = request.accept_mimetypes.best_match(('application/json',) + MSGPACK_MIMETYPES)
+        if best in MSGPACK_MIMETYPES:
+            mimetype = best
+
+    encodings = ('br', 'gzip') if brotli is not None else ('gzip',)
+    encoding = request.accept_encodings.best_match(encodings)
+    return mimetype, encoding
+
+
+def history_payload(fields, rows, columnar=False):
+    """
+    Shape (timestamp, value, ...) rows as {"history": [{field: value}, ...]}, or columnar as
+    {"t": [...], "v": [...], <other field>: [...]}. bench_history_formats.py measures these.
+    """
+    if not columnar:
+        return {'history': [dict(zip(fields, row)) for row in rows]}
+    columns = list(zip(*rows)) if rows else [()] * len(fields)
+    payload = {'t': list(columns[0]), 'v': list(columns[1])}
+    for field, column in zip(fields[2:], columns[2:]):
+        payload[field] = list(column)
+    return payload
+
+
+def history_response(fields, rows):
+    """
+    Build a history response from (timestamp, value, ...) rows in the negotiated shape and format.
+    """
+    payload = history_payload(fields, rows, columnar=request.args.get('shape') == 'columnar')
+
+    mimetype, _ = negotiate_representation()
+    if mimetype in MSGPACK_MIMETYPES:
+        return app.response_class(msgpack.packb(payload), mimetype=mimetype)
+    return jsonify(payload)
+
+
+def compress_response(response):
+    """
+    Compress a buffered response body with brotli or gzip when it is large enough to be worth it.
+    """
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or response.content_encoding):
+        return response
+
+    _, encoding = negotiate_representation()
+    if not encoding:
+        return response
+
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+
+    if encoding == 'br':
+        response.set_data(brotli.compress(body, quality=5))
+    else:
+        response.set_data(gzip.compress(body, compresslevel=6))
+    response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@app.after_request
+def compress_large_responses(response):
+    return compress_response(response)
+
+
+# ==================== Ingest pipeline ====================
+# Every stored reading is passed through the registered stages right after it is
+# written. Stages run inline on the writer's thread, so each one must do a constant
+# amount of work per reading.
+
+# Numeric fields of each series that per-reading analytics run on.
+SERIES_NUMERIC_FIELDS = {
+    'temperature': ('value',),
+    'water_heater': ('temperature',),
+    'light_control': ('intensity',),
+    'fps': ('fps',),
+    'aircon': ('temperature', 'humidity'),
+    'surveillance_camera': ()
+}
+
+ingest_stages = []
+
+
+def ingest_stage(stage):
+    """
+    Register a function(series, reading) to run for every stored reading.
+    """
+    ingest_stages.append(stage)
+    return stage
+
+
+def run_ingest_stages(series, reading):
+    for stage in ingest_stages:
+        try:
+            stage(series, reading)
+        except Exception as e:
+            print(f"[Error] Ingest stage {stage.__name__} failed for {series}: {e}")
+
+
+def numeric_fields(series, reading):
+    """
+    Yield (field, float value) for the numeric fields of a reading, skipping missing or invalid values.
+    """
+    for field in SERIES_NUMERIC_FIELDS.get(series, ()):
+        try:
+            yield field, float(reading[field])
+        except (KeyError, TypeError, ValueError):
+            continue
+
+
+# ==================== Rolling statistics ====================
+
+# Window sizes are in samples; at the simulators' 5 second cadence the defaults cover 1 minute, 5 minutes and 1 hour.
+STATS_WINDOWS = tuple(int(size) for size in os.environ.get('STATS_WINDOWS', '12,60,720').split(',') if size.strip())
+STATS_EWMA_ALPHA = 0.2
+
+
+class RollingWindow:
+    """
+    Mean and variance over the last `size` samples, maintained in O(1) per sample.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.values = deque(maxlen=size)
+        self.mean = 0.0
+        # Sum of squared deviations from the mean (Welford), which does not lose precision like sum(x*x).
+        self.m2 = 0.0
+
+    def push(self, value):
+        count = len(self.values)
+        if self.size == 1:
+            self.values.append(value)
+            self.mean, self.m2 = value, 0.0
+        elif count < self.size:
+            self.values.append(value)
+            delta = value - self.mean
+            self.mean += delta / (count + 1)
+            self.m2 += delta * (value - self.mean)
+        else:
+            # Full window: replace the oldest sample in one step.
+            oldest = self.values[0]
+            self.values.append(value)
+            old_mean = self.mean
+            self.mean += (value - oldest) / count
+            self.m2 += (value - oldest) * (value - self.mean + oldest - old_mean)
+        self.m2 = max(self.m2, 0.0)
+
+    def summary(self):
+        count = len(self.values)
+        if count == 0:
+            return {'count': 0, 'mean': None, 'variance': None}
+        return {'count': count, 'mean': round(self.mean, 4), 'variance': round(self.m2 / count, 4)}
+
+
+class SeriesStats:
+    """
+    Streaming statistics for one numeric field: last value, EWMA, rolling windows and daily min/max.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.last = None
+        self.last_timestamp = None
+        self.ewma = None
+        self.windows = [RollingWindow(size) for size in STATS_WINDOWS]
+        self.day = None
+        self.day_min = None
+        self.day_max = None
+
+    def update(self, value, timestamp):
+        self.count += 1
+        self.last = value
+        self.last_timestamp = timestamp
+        self.ewma = value if self.ewma is None else STATS_EWMA_ALPHA * value + (1 - STATS_EWMA_ALPHA) * self.ewma
+        for window in self.windows:
+            window.push(value)
+
+        # Timestamps are "YYYY-MM-DD HH:MM:SS"; the date prefix decides when the daily extremes reset.
+        day = str(timestamp)[:10]
+        if day != self.day:
+            self.day, self.day_min, self.day_max = day, value, value
+        else:
+            self.day_min = min(self.day_min, value)
+            self.day_max = max(self.day_max, value)
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'last': self.last,
+            'timestamp': self.last_timestamp,
+            'ewma': round(self.ewma, 4) if self.ewma is not None else None,
+            'windows': {str(window.size): window.summary() for window in self.windows},
+            'day': self.day,
+            'day_min': self.day_min,
+            'day_max': self.day_max
+        }
+
+
+series_stats = {}
+series_stats_lock = threading.Lock()
+
+
+@ingest_stage
+def update_series_stats(series, reading):
+    timestamp = reading.get('timestamp')
+    with series_stats_lock:
+        for field, value in numeric_fields(series, reading):
+            key = (series, field)
+            if key not in series_stats:
+                series_stats[key] = SeriesStats()
+            series_stats[key].update(value, timestamp)
+
+
+def stats_summary(series=None):
+    with series_stats_lock:
+        result = {}
+        for (name, field), stats in series_stats.items():
+            if series is None or name == series:
+                result.setdefault(name, {})[field] = stats.summary()
+        return result
+
+
+@app.route('/api/stats', methods=['GET'])
+def get_all_series_stats():
+    return jsonify(shared_stats('series', stats_summary) or {})
+
+
+@app.route('/api/stats/<series>', methods=['GET'])
+def get_series_stats(series):
+    if series not in SERIES_NUMERIC_FIELDS:
+        return jsonify({'error': f"Unknown series '{series}'"}), 404
+    return jsonify((shared_stats('series', stats_summary) or {}).get(series, {}))
+
+
+# ==================== Streaming anomaly detection ====================
+# Each numeric field keeps an exponentially weighted mean and variance. A reading is
+# scored against the baseline before it is folded in; an alert is raised when |z|
+# crosses ANOMALY_RAISE_Z and cleared only once it falls back under ANOMALY_CLEAR_Z,
+# so a value hovering around the threshold does not flap. Only state transitions
+# publish and persist, keeping the per-reading cost constant.
+
+ANOMALY_ALPHA = 0.05
+ANOMALY_WARMUP = 30
+ANOMALY_RAISE_Z = 3.5
+ANOMALY_CLEAR_Z = 2.0
+
+
+class AnomalyDetector:
+    """
+    Incremental z-score detector with hysteresis for one numeric field.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.variance = 0.0
+        self.active = False
+
+    def observe(self, value):
+        """
+        Fold a value into the baseline and return ('raised' | 'cleared' | None, zscore).
+        """
+        self.count += 1
+        if self.count == 1:
+            self.mean = value
+            return None, 0.0
+
+        diff = value - self.mean
+        std = self.variance ** 0.5
+        zscore = diff / std if std > 0 else 0.0
+
+        self.mean += ANOMALY_ALPHA * diff
+        self.variance = (1 - ANOMALY_ALPHA) * (self.variance + ANOMALY_ALPHA * diff * diff)
+
+        if self.count <= ANOMALY_WARMUP:
+            return None, zscore
+        if not self.active and abs(zscore) >= ANOMALY_RAISE_Z:
+            self.active = True
+            return 'raised', zscore
+        if self.active and abs(zscore) <= ANOMALY_CLEAR_Z:
+            self.active = False
+            return 'cleared', zscore
+        return None, zscore
+
+
+anomaly_detectors = {}
+active_alerts = {}
+anomaly_lock = threading.Lock()
+
+
+def save_alert_to_db(device, field, state, value, zscore, timestamp):
+    conn = sqlite3.connect('alerts.db')
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO alert_data (device, field, state, value, zscore, timestamp)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (device, field, state, value, zscore, timestamp))
+    conn.commit()
+    conn.close()
+    bump_table_version('alert_data')
+
+
+@ingest_stage
+def detect_anomalies(series, reading):
+    timestamp = reading.get('timestamp')
+    for field, value in numeric_fields(series, reading):
+        key = (series, field)
+        with anomaly_lock:
+            if key not in anomaly_detectors:
+                anomaly_detectors[key] = AnomalyDetector()
+            state, zscore = anomaly_detectors[key].observe(value)
+            if state is None:
+                continue
+            alert = {
+                'device': series,
+                'field': field,
+                'state': state,
+                'value': value,
+                'zscore': round(zscore, 3),
+                'timestamp': timestamp
+            }
+            if state == 'raised':
+                active_alerts[key] = alert
+            else:
+                active_alerts.pop(key, None)
+
+        save_alert_to_db(series, field, state, value, alert['zscore'], timestamp)
+        print(f"[Alert] {series}.{field} {state}: value {value}, z-score {alert['zscore']}")
+        if mqtt_client:
+            mqtt_client.publish(f"alerts/{series}", json.dumps(alert))
+        event_stream.publish(f"alerts/{series}", alert)
+
+
+# ==================== Latest-state snapshot ====================
+# The write path keeps the newest reading of every series in memory, so realtime
+# routes answer without opening a database. Device control state lives in
+# device_registry and is merged in by /api/snapshot.
+
+# Where to load a series' newest row from the first time it is asked for before any reading arrived.
+LATEST_READING_SOURCES = {
+    'temperature': ('temperature.db', 'temperature_data', ('value', 'timestamp')),
+    'water_heater': ('water_heater.db', 'water_heater_data', ('temperature', 'status', 'timestamp')),
+    'light_control': ('light_control.db', 'light_control_data', ('intensity', 'status', 'timestamp')),
+    'fps': ('fps.db', 'fps_data', ('fps', 'timestamp')),
+    'surveillance_camera': ('surveillance_camera.db', 'surveillance_camera_data', ('status', 'timestamp')),
+    'aircon': ('aircon.db', 'aircon_data',
+               ('temperature', 'humidity', 'cooling_status', 'dehumidifying_status', 'timestamp'))
+}
+
+
+class LatestStateSnapshot:
+    """
+    Versioned newest reading per series.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.readings = {}
+        # Shared store of serve.py; when set, readings live there instead of in this process.
+        self.store = None
+
+    def update_reading(self, series, reading, only_if_missing=False):
+        if self.store is not None:
+            entry = {'version': self.store.incr('latest'), 'data': dict(reading)}
+            self.store.set(f"latest:{series}", entry, only_if_missing)
+            return
+        with self.lock:
+            if only_if_missing and series in self.readings:
+                return
+            self.version += 1
+            self.readings[series] = {'version': self.version, 'data': dict(reading)}
+
+
+    def get_reading(self, series):
+        if self.store is not None:
+            entry = self.store.get(f"latest:{series}")
+            return entry['data'] if entry else None
+        with self.lock:
+            entry = self.readings.get(series)
+            return entry['data'] if entry else None
+
+    def as_dict(self):
+        if self.store is not None:
+            return {'version': self.store.counter('latest'), 'readings': self.store.items('latest:')}
+        with self.lock:
+            return {
+                'version': self.version,
+                'readings': {series: dict(entry) for series, entry in self.readings.items()}
+            }
+
+
+latest_state = LatestStateSnapshot()
+
+
+@ingest_stage
+def update_latest_state(series, reading):
+    latest_state.update_reading(series, reading)
+
+
+def latest_row(series, columns):
+    """
+    Return the newest reading of a series as a tuple of `columns`, or None when there is none.
+    """
+    reading = latest_state.get_reading(series)
+    if reading is None:
+        db, table, source_columns = LATEST_READING_SOURCES[series]
+        conn = sqlite3.connect(db)
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT {', '.join(source_columns)} FROM {table} ORDER BY id DESC LIMIT 1")
+        row = cursor.fetchone()
+        conn.close()
+        if row is None:
+            return None
+        # A reading ingested while the query ran is newer than the row, so it must not be overwritten.
+        latest_state.update_reading(series, dict(zip(source_columns, row)), only_if_missing=True)
+        reading = latest_state.get_reading(series)
+    return tuple(reading.get(column) for column in columns)
+
+
+@app.route('/api/snapshot', methods=['GET'])
+def get_snapshot():
+    snapshot = latest_state.as_dict()
+    snapshot['devices_version'] = device_registry.device_version()
+    snapshot['devices'] = dict(device_registry.all())
+    return jsonify(snapshot)
+
+
+# ==================== Rule engine for auto mode ====================
+# Rules are declarative: a condition over `series.field` references and the status to send
+# a device when it becomes true (and optionally false). Conditions are compiled once into
+# closures and indexed by the series they read, so a reading only evaluates the rules that
+# depend on it. Rules are edge-triggered and only command devices whose mode is 'auto'.
+# A device has a single status, so each device is driven by at most one rule.
+
+DEFAULT_AUTOMATION_RULES = [
+    {'name': 'aircon_cooling', 'when': 'aircon.temperature > 28',
+     'device': 'aircon', 'then': 'COOLING_ON', 'otherwise': 'COOLING_OFF'}
+]
+
+RULE_OPERATORS = {
+    ast.Gt: operator.gt, ast.GtE: operator.ge, ast.Lt: operator.lt, ast.LtE: operator.le,
+    ast.Eq: operator.eq, ast.NotEq: operator.ne,
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv
+}
+
+
+class MissingValue(Exception):
+    pass
+
+
+def compile_condition(expression):
+    """
+    Compile a condition such as "aircon.humidity > 65 and temperature.value < 30" into
+    a function of {series: reading}. Return the function and the set of series it reads.
+    """
+    series_used = set()
+
+    def build(node):
+        if isinstance(node, ast.Expression):
+            return build(node.body)
+        if isinstance(node, ast.BoolOp):
+            operands = [build(value) for value in node.values]
+            if isinstance(node.op, ast.And):
+                return lambda values: all(operand(values) for operand in operands)
+            return lambda values: any(operand(values) for operand in operands)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            operand = build(node.operand)
+            return lambda values: not operand(values)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            operand = build(node.operand)
+            return lambda values: -operand(values)
+        if isinstance(node, ast.Compare):
+            operands = [build(node.left)] + [build(comparator) for comparator in node.comparators]
+            ops = [RULE_OPERATORS[type(op)] for op in node.ops]
+
+            def compare(values):
+                left = operands[0](values)
+                for op, right_operand in zip(ops, operands[1:]):
+                    right = right_operand(values)
+                    if not op(left, right):
+                        return False
+                    left = right
+                return True
+            return compare
+        if isinstance(node, ast.BinOp) and type(node.op) in RULE_OPERATORS:
+            for operand in (node.left, node.right):
+                if isinstance(operand, ast.Constant) and isinstance(operand.value, str):
+                    raise ValueError(f"Arithmetic needs numbers, not '{operand.value}'")
+            op, left, right = RULE_OPERATORS[type(node.op)], build(node.left), build(node.right)
+
+            def arithmetic(values):
+                # Fields can hold strings ("ON"); never repeat or concatenate them.
+                left_value, right_value = left(values), right(values)
+                for value in (left_value, right_value):
+                    if isinstance(value, bool) or not isinstance(value, (int, float)):
+                        raise TypeError(f"Arithmetic needs numbers, not {value!r}")
+                return op(left_value, right_value)
+            return arithmetic
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+            series, field = node.value.id, node.attr
+            if series not in LATEST_READING_SOURCES:
+                raise ValueError(f"Unknown series '{series}'")
+            series_used.add(series)
+
+            def lookup(values):
+                value = (values.get(series) or {}).get(field)
+                if value is None:
+                    raise MissingValue(f"{series}.{field}")
+                return value
+            return lookup
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float, str)):
+            constant = node.value
+            return lambda values: constant
+        raise ValueError(f"Unsupported expression: {ast.dump(node)}")
+
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError as e:
+        raise ValueError(f"Invalid condition '{expression}': {e.msg}")
+    condition = build(tree)
+    if not series_used:
+        raise ValueError(f"Condition '{expression}' does not reference any series")
+    return condition, series_used
+
+
+def parse_rule_status(device, status):
+    """
+    Normalise a rule's status ("on" -> "ON") and check that the device accepts it.
+    """
+    if not isinstance(status, str):
+        raise ValueError(f"Invalid status '{status}'")
+    new_status = STATUS_MAPPING.get(status.lower()) or status.upper()
+    if new_status not in STATUS_MAPPING.values() and new_status not in DEVICE_STATUSES.get(device, ()):
+        raise ValueError(f"Invalid status '{status}' for device '{device}'")
+    return new_status
+
+
+class RuleEngine:
+    """
+    Compiled automation rules indexed by series, with the last outcome of each rule.
+    Under serve.py the definitions live in the shared store, so a rule added through any
+    API worker is evaluated by the ingest process; it publishes each rule's firing count.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rules = {}
+        self.rules_by_series = {}
+        self.store = None
+        self.store_version = None
+
+    def attach(self, store):
+        with self.lock:
+            self.store = store
+            # The first process to attach publishes the rules it starts with.
+            if store.counter('rules') == 0:
+                for name, rule in self.rules.items():
+                    store.set(f"rule:{name}", self._definition(rule), only_if_missing=True)
+                store.incr('rules')
+            self.store_version = None
+
+    def _definition(self, rule):
+        return {key: rule[key] for key in ('name', 'when', 'device', 'then', 'otherwise')}
+
+    def _sync(self):
+        """
+        Reload the rules when another process changed them. Unchanged rules keep their state.
+        """
+        if self.store is None:
+            return
+        version = self.store.counter('rules')
+        if version == self.store_version:
+            return
+        self.store_version = version
+        previous = self.rules
+        self.rules, self.rules_by_series = {}, {}
+        for name, definition in self.store.items('rule:').items():
+            rule = self._compile(definition)
+            known = previous.get(name)
+            if known is not None and self._definition(known) == self._definition(rule):
+                rule.update(state=known['state'], fired=known['fired'], last_fired=known['last_fired'])
+            self._install(rule)
+
+    def _changed(self):
+        version = self.store.incr('rules')
+        if version == self.store_version + 1:
+            self.store_version = version
+
+    def add(self, definition):
+        rule = self._compile(definition)
+        with self.lock:
+            self._sync()
+            for other in self.rules.values():
+                if other['device'] == rule['device'] and other['name'] != rule['name']:
+                    raise ValueError(f"Device '{rule['device']}' is already driven by rule '{other['name']}'")
+            self._remove(rule['name'])
+            self._install(rule)
+            if self.store is not None:
+                self.store.set(f"rule:{rule['name']}", self._definition(rule))
+                self.store.delete(f"rule_stats:{rule['name']}")
+                self._changed()
+        return self._describe(rule)
+
+    def _compile(self, definition):
+        name = definition.get('name')
+        device = definition.get('device')
+        if not name or not device:
+            raise ValueError("A rule needs a 'name' and a 'device'")
+        if not isinstance(name, str) or not isinstance(device, str):
+            raise ValueError("A rule's 'name' and 'device' must be strings")
+        if not definition.get('then'):
+            raise ValueError("A rule needs a 'then' status")
+        condition, series_used = compile_condition(str(definition.get('when', '')))
+        return {
+            'name': name,
+            'when': definition['when'],
+            'device': device,
+            'then': parse_rule_status(device, definition['then']),
+            'otherwise': parse_rule_status(device, definition['otherwise']) if definition.get('otherwise') else None,
+            'series': sorted(series_used),
+            'condition': condition,
+            'state': None,
+            'fired': 0,
+            'last_fired': None
+        }
+
+    def _install(self, rule):
+        self.rules[rule['name']] = rule
+        for series in rule['series']:
+            self.rules_by_series.setdefault(series, []).append(rule)
+
+    def remove(self, name):
+        with self.lock:
+            self._sync()
+            removed = self._remove(name)
+            if removed and self.store is not None:
+                self.store.delete(f"rule:{name}")
+                self.store.delete(f"rule_stats:{name}")
+                self._changed()
+            return removed
+
+    def _remove(self, name):
+        rule = self.rules.pop(name, None)
+        if rule is None:
+            return False
+        for series in rule['series']:
+            self.rules_by_series[series].remove(rule)
+        return True
+
+    def list(self):
+        with self.lock:
+            self._sync()
+            stats = self.store.items('rule_stats:') if self.store is not None else {}
+            return [dict(self._describe(rule), **stats.get(name, {})) for name, rule in self.rules.items()]
+
+    def _describe(self, rule):
+        return {key: value for key, value in rule.items() if key != 'condition'}
+
+    def evaluate(self, series, reading):
+        """
+        Evaluate the rules that read `series` and return the (device, status) commands to issue.
+        """
+        with self.lock:
+            self._sync()
+            rules = list(self.rules_by_series.get(series, ()))
+        if not rules:
+            return []
+
+        values = {series: reading}
+        commands = []
+        with self.lock:
+            for rule in rules:
+                # Rules for devices outside auto mode keep no state, so they resync on the next reading.
+                if (device_registry.fields(rule['device'], ('mode',)) or (None,))[0] != 'auto':
+                    rule['state'] = None
+                    continue
+                for other in rule['series']:
+                    if other not in values:
+                        values[other] = latest_state.get_reading(other)
+                try:
+                    outcome = bool(rule['condition'](values))
+                except (MissingValue, TypeError, ZeroDivisionError):
+                    continue
+                if outcome == rule['state']:
+                    continue
+                rule['state'] = outcome
+                status = rule['then'] if outcome else rule['otherwise']
+                if status is None:
+                    continue
+                rule['fired'] += 1
+                rule['last_fired'] = reading.get('timestamp')
+                if self.store is not None:
+                    self.store.set(f"rule_stats:{rule['name']}",
+                                   {'state': outcome, 'fired': rule['fired'], 'last_fired': rule['last_fired']})
+                commands.append((rule['device'], status))
+        return commands
+
+
+rule_engine = RuleEngine()
+for definition in DEFAULT_AUTOMATION_RULES:
+    rule_engine.add(definition)
+
+
+@ingest_stage
+def apply_automation_rules(series, reading):
+    commands = rule_engine.evaluate(series, reading)
+    if commands:
+        execute_device_commands(commands, manual=False)
+        print(f"[Automation] {series} reading triggered {commands}")
+
+
+@app.route('/api/rules', methods=['GET'])
+def get_rules():
+    return jsonify({"rules": rule_engine.list()})
+
+
+@app.route('/api/rules', methods=['POST'])
+def create_rule():
+    """
+    Add or replace a rule, e.g.
+    {"name": "night_light", "when": "light_control.intensity < 20", "device": "lighting", "then": "on"}.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Expected a JSON object"}), 400
+    if not isinstance(data.get('device'), str) or device_registry.get(data['device']) is None:
+        return jsonify({"error": f"Unknown device '{data.get('device')}'"}), 400
+    try:
+        rule = rule_engine.add(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"status": "success", "rule": rule}), 201
+
+
+@app.route('/api/rules/<name>', methods=['DELETE'])
+def delete_rule(name):
+    if not rule_engine.remove(name):
+        return jsonify({"error": "Rule not found"}), 404
+    return jsonify({"status": "success"}), 200
+
+
+# ==================== Long-poll for device state ====================
+
+LONG_POLL_MAX_SECONDS = 60
+
+
+def wait_for_device_state(device=None):
+    """
+    Honour ?wait=<seconds>&version=<N>: block until the device state version passes N.
+    Return the current version, which clients pass back as `version` on their next poll,
+    or None when `wait` is not a finite number.
+    """
+    wait = request.args.get('wait', type=float)
+    version = request.args.get('version', type=int)
+    if wait is not None and not math.isfinite(wait):
+        return None
+    if wait and version is not None:
+        return device_registry.wait_for_change(device, version, min(max(wait, 0.0), LONG_POLL_MAX_SECONDS))
+    return device_registry.device_version(device)
+
+
+# ==================== Server-Sent Events / WebSocket push stream ====================
+# Browsers subscribe with EventSource to http://<host>:5051/api/stream?devices=aircon,fps
+# (or ?topics= with MQTT wildcards), or open ws://<host>:5051/ws and send
+# {"subscribe": [...]} filters, and receive every reading as it is ingested. Both are
+# served by event_stream.py on its own selector thread, so open connections do not
+# hold Flask worker threads.
+
+EVENT_STREAM_PORT = 5051
+event_stream = EventStreamServer(port=EVENT_STREAM_PORT)
+
+
+@ingest_stage
+def push_to_event_stream(series, reading):
+    event_stream.publish(f"device/{series}", reading)
+
+
+@app.route('/api/stream/stats', methods=['GET'])
+def get_event_stream_stats():
+    stats = shared_stats('stream', event_stream.stats)
+    if stats is None:
+        return jsonify({"error": "The push stream is not running"}), 404
+    return jsonify(stats)
+
+
+@app.route('/api/alerts', methods=['GET'])
+@conditional_get('alert_data')
+def get_alert_history():
+    device = request.args.get('device')
+    limit = request.args.get('limit', 100, type=int)
+
+    conn = sqlite3.connect('alerts.db')
+    cursor = conn.cursor()
+    if device:
+        cursor.execute('''
+            SELECT device, field, state, value, zscore, timestamp FROM alert_data
+            WHERE device = ? ORDER BY timestamp DESC LIMIT ?
+        ''', (device, limit))
+    else:
+        cursor.execute('''
+            SELECT device, field, state, value, zscore, timestamp FROM alert_data
+            ORDER BY timestamp DESC LIMIT ?
+        ''', (limit,))
+    rows = cursor.fetchall()
+    conn.close()
+
+    fields = ('device', 'field', 'state', 'value', 'zscore', 'timestamp')
+    return jsonify({'alerts': [dict(zip(fields, row)) for row in rows]})
+
+
+@app.route('/api/alerts/active', methods=['GET'])
+def get_active_alerts():
+    with anomaly_lock:
+        return jsonify({'alerts': list(active_alerts.values())})
+
+
 def save_to_db(value, timestamp):
     conn = sqlite3.connect('temperature.db')
     cursor = conn.cursor()
     cursor.execute('INSERT INTO temperature_data (value, timestamp) VALUES (?, ?)', (value, timestamp))
     conn.commit()
     conn.close()
+    bump_table_version('temperature_data')
+    run_ingest_stages('temperature', {'value': value, 'timestamp': timestamp})
 
 
 def save_water_heater_to_db(temperature, status, timestamp):
@@ -376,6 +2551,8 @@ def save_water_heater_to_db(temperature, status, timestamp):
                    (temperature, status, timestamp))
     conn.commit()
     conn.close()
+    bump_table_version('water_heater_data')
+    run_ingest_stages('water_heater', {'temperature': temperature, 'status': status, 'timestamp': timestamp})
 
 
 def save_light_control_to_db(intensity, status, timestamp):
@@ -385,6 +2562,8 @@ def save_light_control_to_db(intensity, status, timestamp):
                    (intensity, status, timestamp))
     conn.commit()
     conn.close()
+    bump_table_version('light_control_data')
+    run_ingest_stages('light_control', {'intensity': intensity, 'status': status, 'timestamp': timestamp})
 
 
 def save_fps_to_db(fps, timestamp):
@@ -393,6 +2572,8 @@ def save_fps_to_db(fps, timestamp):
     cursor.execute('INSERT INTO fps_data (fps, timestamp) VALUES (?, ?)', (fps, timestamp))
     conn.commit()
     conn.close()
+    bump_table_version('fps_data')
+    run_ingest_stages('fps', {'fps': fps, 'timestamp': timestamp})
 
 
 def save_surveillance_camera_to_db(status, timestamp):
@@ -401,6 +2582,8 @@ def save_surveillance_camera_to_db(status, timestamp):
     cursor.execute('INSERT INTO surveillance_camera_data (status, timestamp) VALUES (?, ?)', (status, timestamp))
     conn.commit()
     conn.close()
+    bump_table_version('surveillance_camera_data')
+    run_ingest_stages('surveillance_camera', {'status': status, 'timestamp': timestamp})
 
 def save_aircon_to_db(temperature, humidity, cooling_status, dehumidifying_status, timestamp):
     conn = sqlite3.connect('aircon.db')
@@ -411,6 +2594,14 @@ def save_aircon_to_db(temperature, humidity, cooling_status, dehumidifying_statu
     ''', (temperature, humidity, cooling_status, dehumidifying_status, timestamp))
     conn.commit()
     conn.close()
+    bump_table_version('aircon_data')
+    run_ingest_stages('aircon', {
+        'temperature': temperature,
+        'humidity': humidity,
+        'cooling_status': cooling_status,
+        'dehumidifying_status': dehumidifying_status,
+        'timestamp': timestamp
+    })
 
 @app.route('/api/device/<device>/save-state', methods=['POST'])
 def save_device_state(device):
@@ -423,23 +2614,11 @@ def save_device_state(device):
         if not status or not mode:
             return jsonify({"error": "Missing status or mode"}), 400
 
-        conn = sqlite3.connect('device_control.db')
-        cursor = conn.cursor()
-
         # Fix update logic: Use modal updates
-        cursor.execute('''
-            UPDATE device_control
-            SET status = ?, manual_override = ?
-            WHERE device = ?
-        ''', (status.upper(), mode, device))
-
-        if cursor.rowcount == 0:
-            conn.close()
+        if device_registry.update(device, status=status.upper(), manual_override=mode) is None:
             print(f"[Error] Device '{device}' not found in database.")
             return jsonify({"error": f"Device '{device}' not found"}), 404
 
-        conn.commit()
-        conn.close()
         print(f"[Database synchronization] {device} Status: {status}, Mode: {mode}")
 
         return jsonify({"message": f"{device} state saved successfully"}), 200
@@ -635,6 +2814,10 @@ def connect_mqtt():
         return jsonify({'status': 'error', 'message': 'Incomplete parameters'}), 400
 
     try:
+        # Two connected clients would both store every reading.
+        if mqtt_client is not None:
+            mqtt_client.disconnect()
+            mqtt_client.loop_stop()
         mqtt_client = mqtt.Client(client_id=client_id)
         mqtt_client.on_connect = on_connect
         mqtt_client.on_message = on_message
@@ -664,19 +2847,14 @@ def subscribe():
 @app.route('/messages/<device_id>', methods=['GET'])   #-----------------------------------------
 def get_messages(device_id):
     topic = f"device/{device_id}"
-    msgs = received_messages.get(topic, [])
+    msgs = recent_messages(topic)
     return jsonify({'topic': topic, 'messages': msgs})
 
 
 @app.route('/api/device/<device>/mode', methods=['GET'])
 def get_device_mode(device):
     try:
-        conn = sqlite3.connect('device_control.db')
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT manual_override FROM device_control WHERE device = ?", (device,))
-        result = cursor.fetchone()
-        conn.close()
+        result = device_registry.fields(device, ('manual_override',))
 
         if result:
             mode = result[0]
@@ -690,11 +2868,7 @@ def get_device_mode(device):
 
 @app.route('/api/device/<device>/current-status', methods=['GET'])
 def get_current_device_status(device):
-    conn = sqlite3.connect('device_control.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT status, manual_override FROM device_control WHERE device=?", (device,))
-    result = cursor.fetchone()
-    conn.close()
+    result = device_registry.fields(device, ('status', 'manual_override'))
 
     if result:
         return jsonify({
@@ -709,7 +2883,7 @@ def get_current_device_status(device):
 def simulate_aircon():
     def run():
         pub_client = mqtt.Client()
-        pub_client.connect("localhost", 1884, 60)
+        pub_client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT, 60)
         pub_client.loop_start()
         while True:
             # Simulate the generated temperature and humidity.
@@ -729,12 +2903,9 @@ def simulate_aircon():
                 "timestamp": timestamp
             }
 
-            # Publish to MQTT
+            # Publish to MQTT; the ingest client stores it.
             pub_client.publish("device/aircon", json.dumps(payload))
 
-            # Save to the database
-            save_aircon_to_db(temperature, humidity, cooling_status, dehumidifying_status, timestamp)
-
             time.sleep(5)
 
     threading.Thread(target=run, daemon=True).start()
@@ -742,13 +2913,12 @@ def simulate_aircon():
 def simulate_temperature():
     def run():
         pub_client = mqtt.Client()
-        pub_client.connect("localhost", 1884, 60)
+        pub_client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT, 60)
         pub_client.loop_start()
         while True:
             temp = round(random.uniform(20.0, 30.0), 2)
             timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             pub_client.publish("device/temperature", json.dumps({"temperature": temp, "timestamp": timestamp}))
-            save_to_db(temp, timestamp)
             time.sleep(5)
 
     threading.Thread(target=run, daemon=True).start()
@@ -757,7 +2927,7 @@ def simulate_temperature():
 def simulate_water_heater():
     def run():
         pub_client = mqtt.Client()
-        pub_client.connect("localhost", 1884, 60)
+        pub_client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT, 60)
         pub_client.loop_start()
         while True:
             temperature = round(random.uniform(30.0, 60.0), 2)
@@ -765,7 +2935,6 @@ def simulate_water_heater():
             timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             pub_client.publish("device/water_heater",
                                json.dumps({"temperature": temperature, "status": status, "timestamp": timestamp}))
-            save_water_heater_to_db(temperature, status, timestamp)
             time.sleep(5)
 
     threading.Thread(target=run, daemon=True).start()
@@ -774,7 +2943,7 @@ def simulate_water_heater():
 def simulate_light_control():
     def run():
         pub_client = mqtt.Client()
-        pub_client.connect("localhost", 1884, 60)
+        pub_client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT, 60)
         pub_client.loop_start()
         while True:
             intensity = round(random.uniform(100.0, 800.0), 2)
@@ -782,7 +2951,6 @@ def simulate_light_control():
             timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             pub_client.publish("device/light_control",
                                json.dumps({"intensity": intensity, "status": status, "timestamp": timestamp}))
-            save_light_control_to_db(intensity, status, timestamp)
             time.sleep(5)
 
     threading.Thread(target=run, daemon=True).start()
@@ -791,22 +2959,45 @@ def simulate_light_control():
 def simulate_fps():
     def run():
         pub_client = mqtt.Client()
-        pub_client.connect("localhost", 1884, 60)
+        pub_client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT, 60)
         pub_client.loop_start()
         while True:
             fps = round(random.uniform(20.0, 60.0), 2)
             timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             pub_client.publish("device/fps", json.dumps({"fps": fps, "timestamp": timestamp}))
-            save_fps_to_db(fps, timestamp)
             time.sleep(5)
 
     threading.Thread(target=run, daemon=True).start()
 
 
+def simulate_device_acks():
+    """
+    Play the devices' side of command tracking: acknowledge every command published on
+    device/<device>/command with {"id": ...} on device/<device>/ack.
+    """
+    def on_connect(client, userdata, flags, rc):
+        client.subscribe(DEVICE_COMMAND_TOPIC)
+
+    def on_command(client, userdata, msg):
+        try:
+            command = json.loads(msg.payload.decode('utf-8'))
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            return
+        if isinstance(command, dict) and command.get('id'):
+            client.publish(f"device/{msg.topic.split('/')[1]}/ack", json.dumps({'id': command['id']}))
+
+    client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_message = on_command
+    client.connect_async(MQTT_BROKER_HOST, MQTT_BROKER_PORT, 60)
+    client.loop_start()
+    return client
+
+
 def simulate_surveillance_camera():
     def run():
         pub_client = mqtt.Client()
-        pub_client.connect("localhost", 1884, 60)
+        pub_client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT, 60)
         pub_client.loop_start()
         while True:
             status = random.choice(['recording', 'idle'])
@@ -822,7 +3013,7 @@ def simulate_surveillance_camera():
 @app.route('/api/realtime/fps', methods=['GET'])
 def get_latest_fps():
     topic = "device/fps"
-    msgs = received_messages.get(topic, [])
+    msgs = recent_messages(topic, 1)
 
     if msgs:
         return jsonify(msgs[-1])
@@ -831,6 +3022,8 @@ def get_latest_fps():
 
 
 @app.route('/api/history/fps', methods=['GET'])
+@conditional_get('fps_data')
+@cached_response('fps_data')
 def get_fps_history():
     conn = sqlite3.connect('fps.db')
     cursor = conn.cursor()
@@ -838,14 +3031,13 @@ def get_fps_history():
     rows = cursor.fetchall()
     conn.close()
 
-    history = [{'timestamp': row[0], 'fps': row[1]} for row in rows]
-    return jsonify({'history': history})
+    return history_response(('timestamp', 'fps'), rows)
 
 
 @app.route('/api/realtime/temperature', methods=['GET'])
 def get_latest_temperature():
     topic = "device/temperature"
-    msgs = received_messages.get(topic, [])
+    msgs = recent_messages(topic, 1)
 
     if msgs:
         return jsonify(msgs[-1])
@@ -856,7 +3048,7 @@ def get_latest_temperature():
 @app.route('/api/realtime/water_heater', methods=['GET'])
 def get_latest_water_heater():
     topic = "device/water_heater"
-    msgs = received_messages.get(topic, [])
+    msgs = recent_messages(topic, 1)
 
     if msgs:
         return jsonify(msgs[-1])
@@ -867,7 +3059,7 @@ def get_latest_water_heater():
 @app.route('/api/realtime/light-control', methods=['GET'])
 def get_latest_light_control():
     topic = "device/light_control"
-    msgs = received_messages.get(topic, [])
+    msgs = recent_messages(topic, 1)
 
     if msgs:
         return jsonify(msgs[-1])
@@ -876,6 +3068,8 @@ def get_latest_light_control():
 
 
 @app.route('/api/history/temperature', methods=['GET'])
+@conditional_get('temperature_data')
+@cached_response('temperature_data')
 def get_temperature_history():
     """
     API to fetch historical temperature data
@@ -888,14 +3082,15 @@ def get_temperature_history():
         conn.close()
 
         #Map into a format acceptable to the front-end.
-        history = [{'timestamp': row[0], 'temperature': row[1]} for row in rows]
-        return jsonify({'history': history})
+        return history_response(('timestamp', 'temperature'), rows)
     except Exception as e:
         
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/history/aircon', methods=['GET'])
+@conditional_get('temperature_data')
+@cached_response('temperature_data')
 def get_temperature_aircon_history():
     conn = sqlite3.connect('temperature.db')
     cursor = conn.cursor()
@@ -903,11 +3098,12 @@ def get_temperature_aircon_history():
     rows = cursor.fetchall()
     conn.close()
 
-    history = [{'timestamp': row[0], 'temperature': row[1]} for row in rows]
-    return jsonify({'history': history})
+    return history_response(('timestamp', 'temperature'), rows)
 
 
 @app.route('/api/history/water_heater', methods=['GET'])
+@conditional_get('water_heater_data')
+@cached_response('water_heater_data')
 def get_water_heater_history():
     conn = sqlite3.connect('water_heater.db')
     cursor = conn.cursor()
@@ -915,11 +3111,12 @@ def get_water_heater_history():
     rows = cursor.fetchall()
     conn.close()
 
-    history = [{'timestamp': row[0], 'temperature': row[1], 'status': row[2]} for row in rows]
-    return jsonify({'history': history})
+    return history_response(('timestamp', 'temperature', 'status'), rows)
 
 
 @app.route('/api/history/light_control', methods=['GET'])
+@conditional_get('light_control_data')
+@cached_response('light_control_data')
 def get_light_control_history():
     conn = sqlite3.connect('light_control.db')
     cursor = conn.cursor()
@@ -927,8 +3124,7 @@ def get_light_control_history():
     rows = cursor.fetchall()
     conn.close()
 
-    history = [{'timestamp': row[0], 'intensity': row[1], 'status': row[2]} for row in rows]
-    return jsonify({'history': history})
+    return history_response(('timestamp', 'intensity', 'status'), rows)
 
 
 @app.route('/api/device/<device>/status', methods=['GET'])
@@ -936,11 +3132,7 @@ def get_device_status(device):
     """
     Get the current mode and status of the device.
     """
-    conn = sqlite3.connect('device_control.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT mode, status FROM device_control WHERE device = ?", (device,))
-    result = cursor.fetchone()
-    conn.close()
+    result = device_registry.fields(device, ('mode', 'status'))
 
     if result:
         return {"mode": result[0], "status": result[1]}
@@ -951,25 +3143,16 @@ def get_device_status(device):
 @app.route('/api/device/water_heater/on', methods=['POST'])
 def turn_on_water_heater():
     try:
-        conn = sqlite3.connect('device_control.db')
-        cursor = conn.cursor()
-        cursor.execute("UPDATE device_control SET status = 'ON' WHERE device = 'water_heater'")
-
         # Check if the database is actually updated.
-        if cursor.rowcount == 0:
+        if device_registry.update('water_heater', status='ON') is None:
             print("[Error] Water Heater not found or update failed.")
-            conn.close()
             return jsonify({"message": "Failed to update Water Heater"}), 500
 
-        conn.commit()
-        conn.close()
-
-        # Confirm that MQTT is connected.
-        if mqtt_client:
-            mqtt_client.publish("device/water_heater/control", "ON")
+        # Queued until the broker is reachable if MQTT is not connected.
+        if send_device_message('water_heater', "device/water_heater/control", "ON"):
             print("[MQTT] Published: device/water_heater/control -> ON")
         else:
-            print("[Warning] MQTT Client not connected.")
+            print("[Warning] MQTT Client not connected, command queued.")
 
         return jsonify({"message": "Water Heater turned on"}), 200
     except Exception as e:
@@ -980,24 +3163,15 @@ def turn_on_water_heater():
 @app.route('/api/device/water_heater/off', methods=['POST'])
 def turn_off_water_heater():
     try:
-        conn = sqlite3.connect('device_control.db')
-        cursor = conn.cursor()
-        cursor.execute("UPDATE device_control SET status = 'OFF' WHERE device = 'water_heater'")
-
-        if cursor.rowcount == 0:
-            conn.close()
+        if device_registry.update('water_heater', status='OFF') is None:
             print("[Error] Water Heater not found or update failed.")
             return jsonify({"message": "Failed to update Water Heater"}), 500
 
-        conn.commit()
-        conn.close()
-
-        # Confirm that MQTT is connected.
-        if mqtt_client:
-            mqtt_client.publish("device/water_heater/control", "OFF")
+        # Queued until the broker is reachable if MQTT is not connected.
+        if send_device_message('water_heater', "device/water_heater/control", "OFF"):
             print("[MQTT] Published: device/water_heater/control -> OFF")
         else:
-            print("[Warning] MQTT Client not connected.")
+            print("[Warning] MQTT Client not connected, command queued.")
 
         return jsonify({"message": "Water Heater turned off"}), 200
     except Exception as e:
@@ -1011,22 +3185,17 @@ def switch_water_heater_mode():
     mode = data.get('mode')
     if mode not in ['manual', 'auto']:
         return jsonify({"message": "Invalid mode"}), 400
-    conn = sqlite3.connect('device_control.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE device_control SET mode = ? WHERE device = 'water_heater'", (mode,))
-    conn.commit()
-    conn.close()
+    device_registry.update('water_heater', mode=mode)
     return jsonify({"message": f"Water Heater mode set to {mode}"}), 200
 
 
 @app.route('/api/device/lighting/increase', methods=['POST'])
 def increase_lighting():
-    conn = sqlite3.connect('device_control.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT mode FROM device_control WHERE device = 'lighting'")
-    mode = cursor.fetchone()[0]
-    if mode == 'manual':
-        mqtt_client.publish("device/lighting/control", "BRIGHTER")
+    result = device_registry.fields('lighting', ('mode',))
+    if result is None:
+        return jsonify({"error": "Device 'lighting' not found"}), 404
+    if result[0] == 'manual':
+        send_device_message('lighting', "device/lighting/control", "BRIGHTER")
         return jsonify({"message": "Lighting brightness increased"}), 200
     else:
         return jsonify({"message": "Lighting is in auto mode, cannot adjust brightness"}), 400
@@ -1034,40 +3203,27 @@ def increase_lighting():
 
 @app.route('/api/device/lighting/off', methods=['POST'])
 def turn_off_lighting():
-    conn = sqlite3.connect('device_control.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE device_control SET status = 'off' WHERE device = 'lighting'")
-    conn.commit()
-    conn.close()
+    command_coalescer.flush('lighting')
+    device_registry.update('lighting', status='off')
 
-    # Preventing mqtt_client is None
-    if mqtt_client:
-        mqtt_client.publish("device/lighting/control", "OFF")
-    else:
-        print("[Warning] MQTT client is not initialized and cannot send messages")
+    # Queued until the broker is reachable if MQTT is not connected.
+    if not send_device_message('lighting', "device/lighting/control", "OFF"):
+        print("[Warning] MQTT client is not connected, command queued")
 
     return jsonify({"message": "Lighting turned off"}), 200
 
 
 @app.route('/api/device/camera/start', methods=['POST'])
 def start_camera():
-    conn = sqlite3.connect('device_control.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE device_control SET status = 'on' WHERE device = 'camera'")
-    conn.commit()
-    conn.close()
-    mqtt_client.publish("device/camera/control", "START")
+    device_registry.update('camera', status='on')
+    send_device_message('camera', "device/camera/control", "START")
     return jsonify({"message": "Camera started"}), 200
 
 
 @app.route('/api/device/camera/stop', methods=['POST'])
 def stop_camera():
-    conn = sqlite3.connect('device_control.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE device_control SET status = 'off' WHERE device = 'camera'")
-    conn.commit()
-    conn.close()
-    mqtt_client.publish("device/camera/control", "STOP")
+    device_registry.update('camera', status='off')
+    send_device_message('camera', "device/camera/control", "STOP")
     return jsonify({"message": "Camera stopped"}), 200
 
 
@@ -1075,29 +3231,75 @@ def stop_camera():
 def toggle_mode():
     data = request.get_json()
     manual_mode = data.get('manual_mode')
-
-    conn = sqlite3.connect('device_control.db')
-    cursor = conn.cursor()
+    home_id = data.get('home_id', DEFAULT_HOME_ID)
 
     if manual_mode == "on":
-        cursor.execute('UPDATE device_control SET manual_override = "on"')
+        device_registry.update_all(home_id, manual_override="on")
     else:
-        cursor.execute('UPDATE device_control SET manual_override = "off"')
+        device_registry.update_all(home_id, manual_override="off")
 
-    conn.commit()
-    conn.close()
-
-    print(f"[Database synchronization] Switch mode to: {manual_mode}")
+    print(f"[Database synchronization] Switch mode of home {home_id} to: {manual_mode}")
     return jsonify({"message": f"Device mode set to {manual_mode}"}), 200
 
 
+@app.route('/api/homes', methods=['GET'])
+def get_homes():
+    return jsonify({"homes": device_registry.home_summary()})
+
+
+@app.route('/api/homes/<home_id>/devices', methods=['GET'])
+def get_home_devices(home_id):
+    version = device_registry.device_version(None, home_id)
+    devices = [dict(state, device=device) for device, state in device_registry.all(home_id)]
+    if not devices:
+        return jsonify({"error": f"Unknown home '{home_id}'"}), 404
+    return jsonify({"home_id": home_id, "version": version, "devices": devices})
+
+
+@app.route('/api/homes/<home_id>/devices', methods=['POST'])
+def add_home_devices(home_id):
+    """
+    Register devices in a home, e.g. [{"device": "lighting"}, {"device": "aircon", "mode": "manual"}].
+    """
+    if '+' in home_id or '#' in home_id:
+        return jsonify({"error": f"Invalid home '{home_id}'"}), 400
+    data = request.get_json(silent=True)
+    devices = data if isinstance(data, list) else [data]
+    rows = []
+    for entry in devices:
+        device = entry.get('device') if isinstance(entry, dict) else None
+        if not isinstance(device, str) or not device or '/' in device or '+' in device or '#' in device:
+            return jsonify({"error": f"Invalid device {entry}"}), 400
+        mode = entry.get('mode', 'auto')
+        if mode not in ['auto', 'manual']:
+            return jsonify({"error": f"Invalid mode for {device}"}), 400
+        status = entry.get('status', 'off')
+        if not isinstance(status, str):
+            return jsonify({"error": f"Invalid status for {device}"}), 400
+        rows.append((device, mode, status))
+
+    added = device_registry.add_devices(home_id, rows)
+    print(f"[Inventory] Home {home_id}: added {len(added)} devices")
+    return jsonify({"status": "success", "home_id": home_id, "added": added}), 201
+
+
+@app.route('/api/homes/<home_id>/toggle-mode', methods=['POST'])
+def toggle_home_mode(home_id):
+    data = request.get_json(silent=True) or {}
+    manual_override = "on" if data.get('manual_mode') == "on" else "off"
+    if device_registry.device_version(None, home_id) == 0:
+        return jsonify({"error": f"Unknown home '{home_id}'"}), 404
+    device_registry.update_all(home_id, manual_override=manual_override)
+    return jsonify({"message": f"Home {home_id} mode set to {manual_override}"}), 200
+
+
 @app.route('/api/device/status', methods=['GET'])
 def get_all_device_status():
-    conn = sqlite3.connect('device_control.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT device, mode, status FROM device_control")
-    rows = cursor.fetchall()
-    conn.close()
+    version = wait_for_device_state()
+    if version is None:
+        return jsonify({"error": "wait must be a finite number of seconds"}), 400
+
+    rows = [(device, state['mode'], state['status']) for device, state in device_registry.all()]
 
     response = []
     for row in rows:
@@ -1108,7 +3310,10 @@ def get_all_device_status():
                 "status": row[2]
             })
 
-    return jsonify(response), 200
+    response = jsonify(response)
+    response.headers['X-State-Version'] = str(version)
+    response.headers['Access-Control-Expose-Headers'] = 'X-State-Version'
+    return response, 200
 
 
 @app.route('/api/device/<device>/mode', methods=['POST'])
@@ -1121,11 +3326,7 @@ def set_device_mode(device):
     if mode not in ['auto', 'manual']:
         return jsonify({"message": "Invalid mode"}), 400
 
-    conn = sqlite3.connect('device_control.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE device_control SET mode = ? WHERE device = ?", (mode, device))
-    conn.commit()
-    conn.close()
+    device_registry.update(device, mode=mode)
 
     return jsonify({"message": f"{device} mode set to {mode}"}), 200
 
@@ -1133,7 +3334,7 @@ def set_device_mode(device):
 @app.route('/api/realtime/surveillance_camera', methods=['GET'])
 def get_latest_surveillance_camera():
     topic = "device/surveillance_camera"
-    msgs = received_messages.get(topic, [])
+    msgs = recent_messages(topic, 1)
 
     if msgs:
         return jsonify(msgs[-1])
@@ -1144,12 +3345,9 @@ def get_latest_surveillance_camera():
 # ==================== New API for Database Queries ====================
 
 @app.route('/api/realtime-db/temperature', methods=['GET'])
+@conditional_get('temperature_data')
 def get_latest_temperature_from_db():
-    conn = sqlite3.connect('temperature.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT value, timestamp FROM temperature_data ORDER BY id DESC LIMIT 1')
-    row = cursor.fetchone()
-    conn.close()
+    row = latest_row('temperature', ('value', 'timestamp'))
 
     if row:
         return jsonify({
@@ -1166,12 +3364,9 @@ def get_latest_temperature_from_db():
 
 
 @app.route('/api/realtime-db/water_heater', methods=['GET'])
+@conditional_get('water_heater_data')
 def get_latest_water_heater_from_db():
-    conn = sqlite3.connect('water_heater.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT temperature, status, timestamp FROM water_heater_data ORDER BY id DESC LIMIT 1')
-    row = cursor.fetchone()
-    conn.close()
+    row = latest_row('water_heater', ('temperature', 'status', 'timestamp'))
 
     if row:
         return jsonify({
@@ -1188,18 +3383,10 @@ def get_latest_water_heater_from_db():
             'message': 'No data available'
         })
 @app.route('/api/device/aircon/view-data', methods=['GET'])
+@conditional_get('aircon_data')
 def get_latest_aircon_data():
     try:
-        conn = sqlite3.connect('aircon.db')
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT temperature, humidity, cooling_status, dehumidifying_status, timestamp
-            FROM aircon_data
-            ORDER BY id DESC
-            LIMIT 1
-        """)
-        row = cursor.fetchone()
-        conn.close()
+        row = latest_row('aircon', ('temperature', 'humidity', 'cooling_status', 'dehumidifying_status', 'timestamp'))
 
         if row:
             data = {
@@ -1225,12 +3412,9 @@ def get_latest_aircon_data():
 
 
 @app.route('/api/realtime-db/fps', methods=['GET'])
+@conditional_get('fps_data')
 def get_latest_fps_from_db():
-    conn = sqlite3.connect('fps.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT fps, timestamp FROM fps_data ORDER BY id DESC LIMIT 1')
-    row = cursor.fetchone()
-    conn.close()
+    row = latest_row('fps', ('fps', 'timestamp'))
 
     if row:
         return jsonify({
@@ -1276,12 +3460,9 @@ def api_control_device(device, action):
 
 
 @app.route('/api/realtime-db/light_control', methods=['GET'])
+@conditional_get('light_control_data')
 def get_latest_light_control_from_db():
-    conn = sqlite3.connect('light_control.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT intensity, status, timestamp FROM light_control_data ORDER BY id DESC LIMIT 1')
-    row = cursor.fetchone()
-    conn.close()
+    row = latest_row('light_control', ('intensity', 'status', 'timestamp'))
 
     if row:
         return jsonify({
@@ -1299,12 +3480,9 @@ def get_latest_light_control_from_db():
         })
 
 @app.route('/api/device/lighting/view-data', methods=['GET'])
+@conditional_get('light_control_data')
 def view_lighting_data():
-    conn = sqlite3.connect('light_control.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT intensity, status, timestamp FROM light_control_data ORDER BY id DESC LIMIT 1')
-    row = cursor.fetchone()
-    conn.close()
+    row = latest_row('light_control', ('intensity', 'status', 'timestamp'))
 
     if row:
         return jsonify({
@@ -1322,12 +3500,9 @@ def view_lighting_data():
         })
 
 @app.route('/api/device/water_heater/view-data', methods=['GET'])
+@conditional_get('water_heater_data')
 def view_water_heater_data():
-    conn = sqlite3.connect('water_heater.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT temperature, status, timestamp FROM water_heater_data ORDER BY id DESC LIMIT 1')
-    row = cursor.fetchone()
-    conn.close()
+    row = latest_row('water_heater', ('temperature', 'status', 'timestamp'))
 
     if row:
         return jsonify({
@@ -1378,16 +3553,17 @@ def get_device_manual_override(device):
     """
     Query the current status of the device in the device_control table and whether it is in manual mode.
     """
-    conn = sqlite3.connect('device_control.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT status, manual_override FROM device_control WHERE device = ?", (device,))
-    result = cursor.fetchone()
-    conn.close()
+    version = wait_for_device_state(device)
+    if version is None:
+        return jsonify({"error": "wait must be a finite number of seconds"}), 400
+
+    result = device_registry.fields(device, ('status', 'manual_override'))
 
     if result:
         return jsonify({
             "status": result[0],
-            "manual_override": result[1]
+            "manual_override": result[1],
+            "version": version
         })
     else:
         return jsonify({
@@ -1396,19 +3572,123 @@ def get_device_manual_override(device):
         }), 404
 
 
-if __name__ == '__main__':
+def broker_stats():
+    if embedded_broker is None:
+        return None
+    return dict(embedded_broker.stats(), host=MQTT_BROKER_HOST, port=MQTT_BROKER_PORT)
+
+
+@app.route('/api/broker/stats', methods=['GET'])
+def get_broker_stats():
+    stats = shared_stats('broker', broker_stats)
+    if stats is None:
+        return jsonify({"error": "The embedded broker is not running"}), 404
+    return jsonify(stats)
+
+
+# ==================== Multi-process serving ====================
+# serve.py runs the API as several worker processes next to one ingest process. State they
+# must agree on lives in a shared_state.SharedState instead of process memory: latest
+# readings, realtime messages, table versions (ETags and cached responses), device control
+# state, schedules and rules. Statistics that only one process can compute (series stats and
+# the push stream in the ingest process, the broker in the supervisor, command latency in
+# each process) are copied into the store every SHARED_STATS_SECONDS by publish_shared_stats.
+# Command tracking, coalescing and queued commands stay per process: a BRIGHTER burst that
+# is coalescing in one worker can still be published after an OFF sent by another worker.
+
+
+def use_shared_state(store):
+    """
+    Switch this process to `store`. Called by serve.py in every process before it serves or ingests.
+    """
+    global shared_state, SERVER_BOOT_ID, SERVER_START_TIME
+    shared_state = store
+    # ETags must be the same whichever worker answers the next poll.
+    store.set('boot', {'id': SERVER_BOOT_ID, 'started': SERVER_START_TIME}, only_if_missing=True)
+    boot = store.get('boot')
+    SERVER_BOOT_ID, SERVER_START_TIME = boot['id'], boot['started']
+    latest_state.store = store
+    device_registry.attach(store)
+    device_scheduler.attach(store)
+    rule_engine.attach(store)
+
+
+def publish_shared_stats(sources):
+    """
+    Copy this process's statistics into the shared store every SHARED_STATS_SECONDS, so any
+    worker can answer for them. `sources` maps a name to the function computing the statistics.
+    """
+    def run():
+        while True:
+            for name, source in sources.items():
+                try:
+                    shared_state.set(f"stats:{name}", source())
+                except Exception as e:
+                    print(f"[Error] Failed to publish {name} statistics: {str(e)}")
+            time.sleep(SHARED_STATS_SECONDS)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def shared_stats(name, local):
+    """
+    Statistics owned by one process: under serve.py as last published by their owner, else computed here.
+    """
+    if shared_state is None:
+        return local()
+    return shared_state.get(f"stats:{name}")
+
+
+def init_databases():
+    init_device_control_db()
+    init_outbound_db()
     init_db()
     init_user_db()
     init_water_heater_db()
     init_light_control_db()
     init_fps_db()
     init_surveillance_camera_db()
-    simulate_temperature()
-    simulate_water_heater()
-    simulate_light_control()
+    init_alert_db()
     init_aircon_db()
-    simulate_aircon()
-    simulate_fps()
-    simulate_surveillance_camera()
-    init_device_control_db()
-    app.run(host='0.0.0.0', port=5050, debug=True)
\ No newline at end of file
+    init_schedule_db()
+
+
+def start_embedded_broker():
+    """
+    Run the in-process broker on the loopback interface and point the backend's clients at it.
+    """
+    global MQTT_BROKER_HOST, MQTT_BROKER_PORT, embedded_broker
+    MQTT_BROKER_HOST = '127.0.0.1'
+    embedded_broker = MQTTBroker(MQTT_BROKER_HOST, MQTT_BROKER_PORT)
+    MQTT_BROKER_PORT = embedded_broker.start()
+
+
+def start_services(simulators=True):
+    """
+    Start everything that runs next to the HTTP API: the ingest client, the simulators,
+    the scheduler and the push stream.
+    """
+    start_backend_client()
+    if simulators:
+        simulate_temperature()
+        simulate_water_heater()
+        simulate_light_control()
+        simulate_aircon()
+        simulate_fps()
+        simulate_surveillance_camera()
+        simulate_device_acks()
+    device_scheduler.start()
+    for series in LATEST_READING_SOURCES:
+        latest_row(series, ())
+    event_stream.start()
+
+
+if __name__ == '__main__':
+    init_databases()
+    # With debug=True the reloader runs this script twice: a file watcher and the serving child.
+    # Only the serving child starts the background services, so each reading is published and stored once.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        if MQTT_EMBEDDED_BROKER:
+            start_embedded_broker()
+        start_services()
+    app.run(host='0.0.0.0', port=5050, debug=True)
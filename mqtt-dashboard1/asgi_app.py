@@ -0,0 +1,577 @@
+"""
+Asynchronous (ASGI) variant of the HTTP API, for thousands of idle long-poll and streaming clients.
+
+An open connection costs a coroutine here instead of a server thread:
+
+- /api/device/status and /api/device/<device>/manual-state with ?wait= wait on an asyncio event
+  that one watcher thread sets whenever the device registry changes;
+- /api/stream sends the ingest events as Server-Sent Events on the API port, in the format of
+  event_stream.py (topic and device filters, Last-Event-ID replay, keepalives);
+- routes with ETags answer 304s and cached bodies on the event loop, without a thread.
+
+Every other request, and every history query that has to run, is passed to the Flask app on a
+bounded thread pool, so SQLite never blocks the event loop and all routes behave as in
+BackencodeEnglish.py. Run one process: it owns the ingest client, simulators and scheduler.
+
+    python asgi_app.py --port 5050          # built-in asyncio HTTP/1.1 server, or uvicorn if installed
+    uvicorn asgi_app:app --port 5050        # any ASGI server
+"""
+import argparse
+import asyncio
+import functools
+import io
+import json
+import math
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, parse_qsl, unquote, urlencode
+
+from werkzeug.exceptions import HTTPException
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+import BackencodeEnglish as backend
+from event_stream import KEEPALIVE_SECONDS, REPLAY_EVENTS, topic_matches
+
+EXECUTOR_THREADS = 16
+STREAM_QUEUE_EVENTS = 256
+# Flask views that long-poll through wait_for_device_state().
+LONG_POLL_VIEWS = ('get_all_device_status', 'get_device_manual_override')
+MAX_HEADER_BYTES = 65536
+# Larger request bodies are refused with 413 before they are read; a full command batch is far smaller.
+MAX_BODY_BYTES = 1024 * 1024
+IDLE_CONNECTION_SECONDS = 75
+
+
+def wsgi_environ(scope, body):
+    """
+    Build the WSGI environ of an ASGI HTTP request whose body has been read.
+    """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f"HTTP_{name}"
+        value = value.decode('latin-1')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def read_body(receive):
+    """
+    Read the request body, or return None once it grows past MAX_BODY_BYTES.
+    """
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] != 'http.request':
+            break
+        body += message.get('body', b'')
+        if len(body) > MAX_BODY_BYTES:
+            return None
+        if not message.get('more_body'):
+            break
+    return bytes(body)
+
+
+def encode_headers(headers):
+    return [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+
+class AsyncAPI:
+    """
+    ASGI application serving the Flask app's routes. Only one instance should run per server.
+    """
+
+    def __init__(self, flask_app, threads=EXECUTOR_THREADS):
+        self.flask_app = flask_app
+        self.threads = threads
+        self.simulators = True
+        self.executor = None
+        self.loop = None
+        # Device and home (None) versions as of the last registry change, read without the registry lock.
+        self.device_versions = {}
+        self.devices_changed = None
+        # (queue, topic filters) of every open /api/stream response.
+        self.streams = set()
+        self.recent = deque(maxlen=REPLAY_EVENTS)
+        self.sequence = 0
+        self.long_polls = 0
+        self.native_requests = 0
+        self.flask_requests = 0
+        self.events_dropped = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.handle_http(scope, receive, send)
+        else:
+            # WebSocket clients connect to event_stream.py on its own port.
+            await send({'type': 'websocket.close', 'code': 1000})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def startup(self):
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='asgi-worker')
+        self.devices_changed = asyncio.Event()
+        await self.loop.run_in_executor(self.executor, self._start_backend)
+        backend.event_stream.listeners.append(self._publish)
+        self.device_versions = await self.loop.run_in_executor(self.executor, self._device_snapshot)
+        threading.Thread(target=self._watch_devices, args=(self.device_versions[None],), daemon=True).start()
+        print(f"[ASGI] Ready with {self.threads} worker threads")
+
+    def shutdown(self):
+        if self._publish in backend.event_stream.listeners:
+            backend.event_stream.listeners.remove(self._publish)
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    def _start_backend(self):
+        backend.init_databases()
+        if backend.MQTT_EMBEDDED_BROKER:
+            backend.start_embedded_broker()
+        backend.start_services(simulators=self.simulators)
+
+    async def handle_http(self, scope, receive, send):
+        body = await read_body(receive)
+        if body is None:
+            await self.send_json(send, {"error": f"Request body exceeds {MAX_BODY_BYTES} bytes"}, 413)
+            return
+        environ = wsgi_environ(scope, body)
+        method, path = scope['method'], scope['path']
+        if method == 'GET' and path == '/api/stream':
+            await self.stream(scope, receive, send)
+            return
+        if method == 'GET' and path == '/api/async/stats':
+            await self.send_json(send, self.stats())
+            return
+
+        try:
+            endpoint, args = self.flask_app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            endpoint, args = None, {}
+        if endpoint in LONG_POLL_VIEWS:
+            environ = await self.long_poll(environ, args.get('device'))
+        elif endpoint is not None and method == 'GET':
+            response = self.answer_early(environ, self.flask_app.view_functions[endpoint])
+            if response is not None:
+                self.native_requests += 1
+                await self.send_response(send, *response)
+                return
+
+        self.flask_requests += 1
+        await self.send_response(send, *await self.loop.run_in_executor(self.executor, self._call_flask, environ))
+
+    def _call_flask(self, environ):
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [int(status.split(' ', 1)[0]), headers]
+
+        result = self.flask_app(environ, start_response)
+        try:
+            body = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return started[0], started[1], body
+
+    def answer_early(self, environ, view):
+        """
+        Answer a GET from its ETag or from history_cache without a thread. Return None when the view has to run.
+        """
+        table = getattr(view, 'conditional_table', None)
+        if table is None:
+            return None
+        # Nothing below waits on the loop, so the request context cannot leak into another task.
+        with self.flask_app.request_context(dict(environ)):
+            etag, last_modified, not_modified = backend.revalidate(table)
+            if not_modified:
+                response = self.flask_app.response_class(status=304)
+            elif getattr(view, 'cached_table', None) == table:
+                # The miss is counted once, by the view's own lookup on the worker thread.
+                response = backend.lookup_cached_response(table, count_miss=False)[2]
+                if response is None:
+                    return None
+            else:
+                return None
+            response = self.flask_app.process_response(backend.set_validators(response, etag, last_modified))
+            return response.status_code, response.headers.to_wsgi_list(), response.get_data()
+
+    async def long_poll(self, environ, device):
+        """
+        Wait out ?wait= on the event loop, then return the environ for the view to answer without waiting.
+        """
+        query = parse_qsl(environ['QUERY_STRING'], keep_blank_values=True)
+        args = dict(query)
+        try:
+            wait, version = float(args['wait']), int(args['version'])
+        except (KeyError, ValueError):
+            return environ
+        if not math.isfinite(wait):
+            # The view rejects it with a 400.
+            return environ
+
+        deadline = self.loop.time() + min(max(wait, 0.0), backend.LONG_POLL_MAX_SECONDS)
+        self.long_polls += 1
+        try:
+            while self.device_versions.get(device, 0) <= version:
+                remaining = deadline - self.loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self.devices_changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            self.long_polls -= 1
+        return dict(environ, QUERY_STRING=urlencode([(name, value) for name, value in query if name != 'wait']))
+
+    def _device_snapshot(self):
+        versions = {device: state['version'] for device, state in backend.device_registry.all()}
+        versions[None] = backend.device_registry.device_version()
+        return versions
+
+    def _watch_devices(self, version):
+        # One thread blocks on the registry for all long polls; each of them waits on an asyncio event.
+        while True:
+            changed = backend.device_registry.wait_for_change(None, version, backend.LONG_POLL_MAX_SECONDS)
+            if changed != version:
+                version = changed
+                self.loop.call_soon_threadsafe(self._devices_changed, self._device_snapshot())
+
+    def _devices_changed(self, versions):
+        self.device_versions = versions
+        # Waiters hold the old event; the next change needs a fresh one.
+        event, self.devices_changed = self.devices_changed, asyncio.Event()
+        event.set()
+
+    def _publish(self, topic, payload):
+        # Called on the ingest threads; encoding there keeps the loop's share of each event small.
+        data = json.dumps({'topic': topic, 'data': payload})
+        self.loop.call_soon_threadsafe(self._dispatch, topic, data)
+
+    def _dispatch(self, topic, data):
+        self.sequence += 1
+        frame = f"id: {self.sequence}\nevent: update\ndata: {data}\n\n".encode('utf-8')
+        self.recent.append((self.sequence, topic, frame))
+        for queue, filters in self.streams:
+            if not filters or any(topic_matches(f, topic) for f in filters):
+                self._offer(queue, frame)
+
+    def _offer(self, queue, item):
+        # A client that does not keep up loses its oldest events rather than growing without bound.
+        if queue.full():
+            queue.get_nowait()
+            self.events_dropped += 1
+        queue.put_nowait(item)
+
+    async def stream(self, scope, receive, send):
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        filters = []
+        for value in query.get('topics', []):
+            filters.extend(t for t in value.split(',') if t)
+        for value in query.get('devices', []):
+            filters.extend(f"device/{d}" for d in value.split(',') if d)
+
+        first = [b'retry: 3000\n\n']
+        # A reconnecting EventSource sends the id of the last event it saw; replay what it missed.
+        headers = dict(scope['headers'])
+        last_id = headers.get(b'last-event-id', b'').decode('latin-1') or (query.get('lastEventId') or [''])[0]
+        if last_id.isdigit():
+            first += [frame for sequence, topic, frame in self.recent if sequence > int(last_id)
+                      and (not filters or any(topic_matches(f, topic) for f in filters))]
+
+        queue = asyncio.Queue(STREAM_QUEUE_EVENTS)
+        subscriber = (queue, tuple(filters))
+        self.streams.add(subscriber)
+
+        async def watch_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            self.streams.discard(subscriber)
+            self._offer(queue, None)
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+        self.native_requests += 1
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'access-control-allow-origin', b'*')
+            ]})
+            await send({'type': 'http.response.body', 'body': b''.join(first), 'more_body': True})
+            while True:
+                try:
+                    frame = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    frame = b': keepalive\n\n'
+                if frame is None:
+                    break
+                frames = [frame]
+                while not queue.empty() and frames[-1] is not None:
+                    frames.append(queue.get_nowait())
+                if frames[-1] is None:
+                    break
+                await send({'type': 'http.response.body', 'body': b''.join(frames), 'more_body': True})
+        except OSError:
+            pass
+        finally:
+            self.streams.discard(subscriber)
+            watcher.cancel()
+
+    def stats(self):
+        return {
+            'worker_threads': self.threads,
+            'native_requests': self.native_requests,
+            'flask_requests': self.flask_requests,
+            'long_polls_waiting': self.long_polls,
+            'stream_clients': len(self.streams),
+            'events_published': self.sequence,
+            'events_dropped': self.events_dropped
+        }
+
+    async def send_json(self, send, payload, status=200):
+        self.native_requests += 1
+        await self.send_response(send, status, [('Content-Type', 'application/json'),
+                                                ('Access-Control-Allow-Origin', '*')],
+                                 json.dumps(payload).encode('utf-8'))
+
+    async def send_response(self, send, status, headers, body):
+        await send({'type': 'http.response.start', 'status': status, 'headers': encode_headers(headers)})
+        await send({'type': 'http.response.body', 'body': body})
+
+
+app = AsyncAPI(backend.app)
+
+
+# ==================== Built-in HTTP/1.1 server ====================
+# Enough HTTP/1.1 for the dashboard without extra packages: keep-alive, Content-Length
+# request bodies and chunked streaming responses.
+
+class Exchange:
+    """
+    receive/send callables of one request on a connection.
+    """
+
+    def __init__(self, reader, writer, body, http_version, keep_alive):
+        self.reader = reader
+        self.writer = writer
+        self.body = body
+        self.http_version = http_version
+        self.keep_alive = keep_alive
+        self.request_sent = False
+        self.status = None
+        self.headers = None
+        self.head_written = False
+        self.chunked = False
+        self.finished = False
+
+    async def receive(self):
+        if not self.request_sent:
+            self.request_sent = True
+            return {'type': 'http.request', 'body': self.body, 'more_body': False}
+        # Only a streaming response reads on; end of input means the client went away.
+        while await self.reader.read(65536):
+            self.keep_alive = False
+        return {'type': 'http.disconnect'}
+
+    async def send(self, message):
+        if message['type'] == 'http.response.start':
+            self.status = message['status']
+            self.headers = list(message.get('headers', []))
+            return
+        if message['type'] != 'http.response.body' or self.finished:
+            return
+
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if not self.head_written:
+            self._write_head(body, more_body)
+        if self.chunked:
+            if body:
+                self.writer.write(b'%x\r\n%s\r\n' % (len(body), body))
+            if not more_body:
+                self.writer.write(b'0\r\n\r\n')
+        else:
+            self.writer.write(body)
+        self.finished = not more_body
+        await self.writer.drain()
+
+    def _write_head(self, body, more_body):
+        names = {name.lower() for name, _ in self.headers}
+        if b'content-length' not in names:
+            if not more_body:
+                self.headers.append((b'content-length', str(len(body)).encode()))
+            elif self.http_version == '1.1':
+                self.chunked = True
+                self.headers.append((b'transfer-encoding', b'chunked'))
+            else:
+                self.keep_alive = False
+        if not self.keep_alive:
+            self.headers.append((b'connection', b'close'))
+        head = [b'HTTP/1.1 %d %s' % (self.status, HTTP_REASONS.get(self.status, b'Unknown'))]
+        head += [name + b': ' + value for name, value in self.headers]
+        self.writer.write(b'\r\n'.join(head) + b'\r\n\r\n')
+        self.head_written = True
+
+
+HTTP_REASONS = {200: b'OK', 201: b'Created', 202: b'Accepted', 204: b'No Content', 304: b'Not Modified',
+                400: b'Bad Request', 401: b'Unauthorized', 403: b'Forbidden', 404: b'Not Found',
+                405: b'Method Not Allowed', 409: b'Conflict', 413: b'Content Too Large',
+                500: b'Internal Server Error', 501: b'Not Implemented', 503: b'Service Unavailable'}
+
+
+async def handle_connection(asgi_app, reader, writer):
+    client = writer.get_extra_info('peername') or ('', 0)
+    server = writer.get_extra_info('sockname') or ('', 0)
+    try:
+        while True:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), IDLE_CONNECTION_SECONDS)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                break
+            lines = head[:-4].decode('latin-1').split('\r\n')
+            try:
+                method, target, protocol = lines[0].split(' ')
+                http_version = protocol.split('/')[1]
+            except (ValueError, IndexError):
+                writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                break
+            headers = []
+            for line in lines[1:]:
+                name, _, value = line.partition(':')
+                headers.append((name.strip().lower().encode('latin-1'), value.strip().encode('latin-1')))
+            fields = dict(headers)
+            if b'chunked' in fields.get(b'transfer-encoding', b'').lower():
+                writer.write(b'HTTP/1.1 501 Not Implemented\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                break
+            try:
+                length = int(fields.get(b'content-length') or 0)
+            except ValueError:
+                length = -1
+            if length < 0:
+                writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                break
+            if length > MAX_BODY_BYTES:
+                # Refused from the header, so the body is never buffered.
+                writer.write(b'HTTP/1.1 413 Content Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                break
+            try:
+                body = await reader.readexactly(length)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+
+            connection = fields.get(b'connection', b'').lower()
+            keep_alive = b'close' not in connection if http_version == '1.1' else b'keep-alive' in connection
+            path, _, query = target.partition('?')
+            scope = {
+                'type': 'http',
+                'asgi': {'version': '3.0', 'spec_version': '2.3'},
+                'http_version': http_version,
+                'method': method,
+                'scheme': 'http',
+                # ASGI paths are percent-decoded, as werkzeug decodes PATH_INFO.
+                'path': unquote(path, errors='replace'),
+                'raw_path': path.encode('latin-1'),
+                'query_string': query.encode('latin-1'),
+                'root_path': '',
+                'headers': headers,
+                'client': client[:2],
+                'server': server[:2]
+            }
+            exchange = Exchange(reader, writer, body, http_version, keep_alive)
+            try:
+                await asgi_app(scope, exchange.receive, exchange.send)
+            except Exception as e:
+                print(f"[ASGI] {method} {path} failed: {e}")
+                if not exchange.head_written:
+                    writer.write(b'HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\n'
+                                 b'Connection: close\r\n\r\n')
+                break
+            if not exchange.finished or not exchange.keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(asgi_app, host, port):
+    await asgi_app.startup()
+    server = await asyncio.start_server(functools.partial(handle_connection, asgi_app), host, port,
+                                        limit=MAX_HEADER_BYTES, backlog=4096)
+    print(f"[ASGI] Listening on http://{host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        asgi_app.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Asynchronous (ASGI) server for the MQTT dashboard backend")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--threads', type=int, default=EXECUTOR_THREADS,
+                        help="threads that run Flask views and their database queries")
+    parser.add_argument('--server', choices=('auto', 'builtin', 'uvicorn'), default='auto',
+                        help="auto uses uvicorn when it is installed")
+    parser.add_argument('--no-simulators', dest='simulators', action='store_false',
+                        help="only ingest real devices")
+    args = parser.parse_args()
+
+    app.threads = args.threads
+    app.simulators = args.simulators
+    if args.server == 'uvicorn' or (args.server == 'auto' and uvicorn is not None):
+        if uvicorn is None:
+            parser.error("uvicorn is not installed; pip install uvicorn or use --server builtin")
+        uvicorn.run(app, host=args.host, port=args.port, log_level='warning',
+                    timeout_keep_alive=IDLE_CONNECTION_SECONDS)
+        return
+    try:
+        asyncio.run(serve(app, args.host, args.port))
+    except KeyboardInterrupt:
+        print("[ASGI] Shutting down")
+
+
+if __name__ == '__main__':
+    main()
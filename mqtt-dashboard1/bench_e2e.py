@@ -0,0 +1,252 @@
+"""
+End-to-end benchmark: device load through MQTT into the ingest pipeline, plus concurrent
+HTTP load on the history, realtime and control routes. Prints (or writes) JSON results.
+
+Everything runs in one process against the embedded broker and a copy of the databases
+in a scratch directory, so runs on the same machine are comparable between commits.
+
+    python bench_e2e.py --devices 2000 --duration 20 --http-clients 8 --output results.json
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import glob
+import http.client
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import paho.mqtt.client as mqtt
+from werkzeug.serving import make_server
+
+import load_generator
+from mqtt_broker import MQTTBroker
+
+# (name, method, path) of the HTTP requests the clients cycle through.
+HTTP_ROUTES = [
+    ('history_temperature', 'GET', '/api/history/temperature'),
+    ('history_aircon', 'GET', '/api/history/aircon'),
+    ('realtime_db_temperature', 'GET', '/api/realtime-db/temperature'),
+    ('realtime_fps', 'GET', '/api/realtime-db/fps'),
+    ('device_status', 'GET', '/api/device/status'),
+    ('control_lighting', 'POST', '/api/device/lighting/on')
+]
+
+
+def percentiles(samples):
+    if not samples:
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None}
+    ordered = sorted(samples)
+
+    def pick(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 2)
+    return {'p50_ms': pick(0.50), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99)}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare_workdir(workdir):
+    """
+    Copy the databases into a scratch directory so the benchmark never writes to the real ones.
+    """
+    for path in glob.glob(os.path.join(HERE, '*.db')):
+        shutil.copy(path, workdir)
+    os.chdir(workdir)
+
+
+class IngestProbe:
+    """
+    Ingest stage that counts stored readings and times probe readings from publish to storage.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ingested = 0
+        self.sent_at = {}
+        self.lags = []
+
+    def __call__(self, series, reading):
+        with self.lock:
+            self.ingested += 1
+            sent_at = self.sent_at.pop(reading.get('timestamp'), None)
+            if sent_at is not None:
+                self.lags.append(time.perf_counter() - sent_at)
+
+    def send(self, client, index):
+        # The fractional part makes the timestamp unique, so the probe can be recognised after storage.
+        timestamp = f"{datetime.datetime.now():%Y-%m-%d %H:%M:%S}.{index:06d}"
+        with self.lock:
+            self.sent_at[timestamp] = time.perf_counter()
+        client.publish('device/fps', json.dumps({'fps': round(random.uniform(20.0, 60.0), 2), 'timestamp': timestamp}))
+
+
+def command_summary(latency):
+    lighting = latency['devices'].get('lighting', {})
+    return dict(acked=latency['acked'], pending=latency['pending'], timed_out=lighting.get('timed_out', 0),
+                **{f"{key[:-3]}_ack_ms": lighting.get(key) for key in ('p50_ms', 'p95_ms', 'p99_ms')})
+
+
+def http_worker(port, deadline, results, seed):
+    rng = random.Random(seed)
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    while time.monotonic() < deadline:
+        name, method, path = rng.choice(HTTP_ROUTES)
+        started = time.perf_counter()
+        try:
+            conn.request(method, path)
+            response = conn.getresponse()
+            response.read()
+            ok = response.status < 500
+        except (OSError, http.client.HTTPException):
+            ok = False
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        results.append((name, time.perf_counter() - started, ok))
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end ingest and API benchmark")
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--interval', type=float, default=1.0, help="seconds between readings of one device")
+    parser.add_argument('--connections', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=15.0)
+    parser.add_argument('--http-clients', type=int, default=8)
+    parser.add_argument('--probe-rate', type=float, default=20.0, help="latency probes per second")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', help="scratch directory for database copies (default: a temporary one)")
+    parser.add_argument('--output', help="write the JSON results to this file")
+    parser.add_argument('--verbose', action='store_true', help="keep the backend's per-message logging")
+    args = parser.parse_args()
+
+    if args.verbose:
+        results = run(args)
+    else:
+        # Per-message prints and request logs would dominate what is being measured.
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            results = run(args)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+    # Control requests that were never acknowledged mean the command/ack path is broken.
+    if results['http']['control_lighting']['requests'] and not results['commands']['acked']:
+        sys.exit("No command acknowledgement was recorded")
+
+
+def run(args):
+
+    random.seed(args.seed)
+    cwd = os.getcwd()
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench-e2e-')
+    prepare_workdir(workdir)
+
+    import BackencodeEnglish as backend
+
+    for init in (backend.init_device_control_db, backend.init_outbound_db, backend.init_db,
+                 backend.init_water_heater_db, backend.init_light_control_db, backend.init_fps_db,
+                 backend.init_surveillance_camera_db, backend.init_aircon_db, backend.init_alert_db):
+        init()
+    probe = IngestProbe()
+    backend.ingest_stage(probe)
+
+    broker = MQTTBroker('127.0.0.1', 0)
+    port = broker.start()
+
+    backend.MQTT_BROKER_HOST, backend.MQTT_BROKER_PORT = '127.0.0.1', port
+    ingest_client = backend.start_backend_client('bench-ingest')
+    # Acknowledges the control route's commands, so publish-to-ack latency is measured too.
+    ack_client = backend.simulate_device_acks()
+
+    probe_client = mqtt.Client(client_id='bench-probe')
+    probe_client.connect('127.0.0.1', port, 60)
+    probe_client.loop_start()
+
+    http_server = make_server('127.0.0.1', 0, backend.app, threaded=True)
+    http_port = http_server.server_port
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    time.sleep(0.5)
+
+    load_args = argparse.Namespace(
+        host='127.0.0.1', port=port, devices=args.devices, interval=args.interval, jitter=0.1,
+        duration=args.duration, connections=args.connections, homes=1, mix=None, format='json',
+        qos=0, keepalive=60, batch=500, report_every=0, json=True)
+    load_summary = {}
+    load_thread = threading.Thread(
+        target=lambda: load_summary.update(asyncio.run(load_generator.run(load_args))), daemon=True)
+
+    http_results = []
+    deadline = time.monotonic() + args.duration
+    started = time.monotonic()
+    ingested_before = probe.ingested
+    load_thread.start()
+    with ThreadPoolExecutor(max_workers=args.http_clients) as pool:
+        for index in range(args.http_clients):
+            pool.submit(http_worker, http_port, deadline, http_results, args.seed + index)
+        index = 0
+        while time.monotonic() < deadline:
+            probe.send(probe_client, index)
+            index += 1
+            time.sleep(1 / args.probe_rate)
+    load_thread.join()
+    elapsed = time.monotonic() - started
+    # Let the ingest client catch up with what was already published before counting.
+    time.sleep(1.0)
+
+    routes = {}
+    for name, _, path in HTTP_ROUTES:
+        samples = [latency for route, latency, _ in http_results if route == name]
+        errors = sum(1 for route, _, ok in http_results if route == name and not ok)
+        routes[name] = dict(path=path, requests=len(samples), errors=errors,
+                            requests_per_s=round(len(samples) / elapsed, 1), **percentiles(samples))
+
+    ingested = probe.ingested - ingested_before
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'config': vars(args),
+        'ingest': dict(
+            published=load_summary.get('sent', 0) + index,
+            ingested=ingested,
+            msgs_per_s=round(ingested / elapsed, 1),
+            probes=index,
+            probes_lost=len(probe.sent_at),
+            **{key.replace('_ms', '_lag_ms'): value for key, value in percentiles(probe.lags).items()}),
+        'http': routes,
+        'commands': command_summary(backend.command_tracker.latency_summary())
+    }
+
+    ingest_client.loop_stop()
+    ack_client.loop_stop()
+    probe_client.loop_stop()
+    http_server.shutdown()
+    broker.stop()
+    os.chdir(cwd)
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Compare the payload size and encode time of the history response formats.
+
+    python bench_history_formats.py --rows 100
+    python bench_history_formats.py --db water_heater.db --table water_heater_data --rows 5000
+"""
+import argparse
+import datetime
+import gzip
+import json
+import random
+import sqlite3
+import time
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from BackencodeEnglish import history_payload
+
+# Tables of the history routes; --table is checked against these before it goes into SQL.
+HISTORY_TABLES = ('temperature_data', 'water_heater_data', 'light_control_data', 'fps_data', 'aircon_data')
+
+
+def synthetic_rows(count):
+    start = datetime.datetime(2025, 1, 1)
+    rows = []
+    for i in range(count):
+        timestamp = (start + datetime.timedelta(seconds=5 * i)).strftime("%Y-%m-%d %H:%M:%S")
+        rows.append((timestamp, round(random.uniform(30.0, 60.0), 2), random.choice(['running', 'stopped'])))
+    return rows
+
+
+def load_rows(db, table, count):
+    conn = sqlite3.connect(db)
+    cursor = conn.cursor()
+    cursor.execute(f'SELECT * FROM {table} ORDER BY id DESC LIMIT ?', (count,))
+    names = [column[0] for column in cursor.description]
+    rows = cursor.fetchall()
+    conn.close()
+
+    # Reorder to (timestamp, value, ...) the way the history routes select them.
+    order = [names.index('timestamp')] + [i for i, name in enumerate(names) if name not in ('id', 'timestamp')]
+    return tuple(names[i] for i in order), [tuple(row[i] for i in order) for row in rows]
+
+
+def time_it(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return result, (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark history response formats")
+    parser.add_argument('--rows', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--db')
+    parser.add_argument('--table', choices=HISTORY_TABLES)
+    args = parser.parse_args()
+
+    if args.db and args.table:
+        fields, rows = load_rows(args.db, args.table, args.rows)
+    else:
+        fields, rows = ('timestamp', 'temperature', 'status'), synthetic_rows(args.rows)
+
+    # The payloads come from the backend, so the benchmark measures exactly what the API serves.
+    serializers = [('json rows', lambda: json.dumps(history_payload(fields, rows)).encode()),
+                   ('json columnar', lambda: json.dumps(history_payload(fields, rows, columnar=True)).encode())]
+    if msgpack is not None:
+        serializers.append(('msgpack rows', lambda: msgpack.packb(history_payload(fields, rows))))
+        serializers.append(('msgpack columnar', lambda: msgpack.packb(history_payload(fields, rows, columnar=True))))
+    else:
+        print("msgpack is not installed, skipping MessagePack formats")
+
+    compressors = [('identity', None), ('gzip', lambda body: gzip.compress(body, compresslevel=6))]
+    if brotli is not None:
+        compressors.append(('br', lambda body: brotli.compress(body, quality=5)))
+    else:
+        print("brotli is not installed, skipping br encoding")
+
+    print(f"{len(rows)} rows, fields {fields}, {args.repeat} repetitions")
+    print(f"{'format':<18}{'encoding':<10}{'bytes':>10}{'encode us':>12}")
+    for name, serialize in serializers:
+        body, encode_us = time_it(serialize, args.repeat)
+        for encoding, compress in compressors:
+            if compress is None:
+                size, total_us = len(body), encode_us
+            else:
+                compressed, compress_us = time_it(lambda: compress(body), args.repeat)
+                size, total_us = len(compressed), encode_us + compress_us
+            print(f"{name:<18}{encoding:<10}{size:>10}{total_us:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
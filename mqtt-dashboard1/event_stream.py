@@ -0,0 +1,478 @@
+"""
+Push server that streams ingest events to browsers as Server-Sent Events or over WebSocket.
+
+All connections are served by one thread using non-blocking sockets and a selector,
+so hundreds of idle clients cost a socket and a small buffer each instead of a thread each.
+
+    new EventSource('http://localhost:5051/api/stream?devices=aircon,fps')
+    new EventSource('http://localhost:5051/api/stream?topics=device/%2B,alerts/%23')
+
+    ws = new WebSocket('ws://localhost:5051/ws?topics=device/%23')
+    ws.send(JSON.stringify({subscribe: ['alerts/+'], unsubscribe: ['device/fps']}))
+
+WebSocket clients that fall behind are not buffered without bound: while their socket
+is backed up, only the newest update per topic is kept and sent once it drains.
+"""
+import base64
+import hashlib
+import json
+import struct
+import selectors
+import socket
+import threading
+import time
+from collections import deque, OrderedDict
+from urllib.parse import urlsplit, parse_qs
+
+MAX_REQUEST_BYTES = 8192
+MAX_CLIENT_BUFFER = 256 * 1024
+KEEPALIVE_SECONDS = 15
+REPLAY_EVENTS = 1024
+MAX_WS_MESSAGE_BYTES = 65536
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+def websocket_frame(opcode, payload):
+    """
+    Encode an unmasked server-to-client WebSocket frame.
+    """
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def parse_websocket_frame(buffer):
+    """
+    Parse one client frame from the start of buffer.
+    Return (fin, opcode, payload, consumed) or None when the frame is incomplete.
+    """
+    if len(buffer) < 2:
+        return None
+    first, second = buffer[0], buffer[1]
+    length = second & 0x7F
+    offset = 2
+    if length == 126:
+        if len(buffer) < 4:
+            return None
+        length = struct.unpack_from('!H', buffer, 2)[0]
+        offset = 4
+    elif length == 127:
+        if len(buffer) < 10:
+            return None
+        length = struct.unpack_from('!Q', buffer, 2)[0]
+        offset = 10
+    masked = second & 0x80
+    mask = b''
+    if masked:
+        if len(buffer) < offset + 4:
+            return None
+        mask = bytes(buffer[offset:offset + 4])
+        offset += 4
+    if length > MAX_WS_MESSAGE_BYTES:
+        raise ValueError("WebSocket frame too large")
+    if len(buffer) < offset + length:
+        return None
+
+    payload = bytes(buffer[offset:offset + length])
+    if masked:
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return bool(first & 0x80), first & 0x0F, payload, offset + length
+
+
+def topic_matches(topic_filter, topic):
+    """
+    MQTT-style topic filter matching with '+' (one level) and '#' (all remaining levels).
+    """
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for i, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class StreamClient:
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.filters = []
+        # None while the HTTP request is still being read, then 'sse' or 'ws'.
+        self.protocol = None
+        self.closing = False
+        # Set once an error response is queued: the socket closes when it has been written out.
+        self.close_when_flushed = False
+        # WebSocket only: newest undelivered frame per topic while the socket is backed up.
+        self.coalesced = OrderedDict()
+        self.message = bytearray()
+
+    def wants(self, topic):
+        return not self.filters or any(topic_matches(f, topic) for f in self.filters)
+
+
+class EventStreamServer:
+    """
+    Single-threaded SSE server. publish() may be called from any thread.
+    """
+
+    def __init__(self, host='0.0.0.0', port=5051):
+        self.host = host
+        self.port = port
+        self.selector = selectors.DefaultSelector()
+        self.clients = {}
+        # Guards self.clients between the selector thread, which changes it, and stats() callers.
+        self.clients_lock = threading.Lock()
+        self.pending = deque()
+        self.pending_lock = threading.Lock()
+        self.recent = deque(maxlen=REPLAY_EVENTS)
+        self.sequence = 0
+        self.events_published = 0
+        self.clients_dropped = 0
+        self.updates_coalesced = 0
+        self.listener = None
+        self.thread = None
+        self.running = False
+        # Functions(topic, payload) called on the publishing thread for every event, such as the ASGI app's stream.
+        self.listeners = []
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+
+    def start(self):
+        """
+        Listen and serve on a background thread. Return False, leaving the API running without
+        push updates, when the port is taken, e.g. by another copy of the backend.
+        """
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.listener.bind((self.host, self.port))
+        except OSError as e:
+            print(f"[Event stream] Cannot listen on {self.host}:{self.port}: {e}")
+            self.listener.close()
+            return False
+        self.listener.listen(512)
+        self.listener.setblocking(False)
+        self.port = self.listener.getsockname()[1]
+
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ, 'accept')
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, 'wakeup')
+
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        print(f"[Event stream] Listening on {self.host}:{self.port}")
+        return True
+
+    def stop(self):
+        self.running = False
+        self._wake()
+        if self.thread:
+            self.thread.join(timeout=2)
+
+    def publish(self, topic, payload):
+        """
+        Queue an event for every client whose filters match the topic.
+        """
+        for listener in self.listeners:
+            listener(topic, payload)
+        if not self.running:
+            return
+        with self.pending_lock:
+            self.pending.append((topic, payload))
+        self._wake()
+
+    def stats(self):
+        with self.clients_lock:
+            protocols = [client.protocol for client in self.clients.values()]
+        return {
+            'sse_clients': protocols.count('sse'),
+            'ws_clients': protocols.count('ws'),
+            'events_published': self.events_published,
+            'clients_dropped': self.clients_dropped,
+            'updates_coalesced': self.updates_coalesced
+        }
+
+    def _wake(self):
+        try:
+            self.wakeup_writer.send(b'\0')
+        except (BlockingIOError, OSError):
+            # The pipe already holds a wake-up byte, which is all the loop needs.
+            pass
+
+    def _run(self):
+        next_keepalive = time.monotonic() + KEEPALIVE_SECONDS
+        while self.running:
+            timeout = max(0.0, next_keepalive - time.monotonic())
+            for key, mask in self.selector.select(timeout):
+                if key.data == 'accept':
+                    self._accept()
+                elif key.data == 'wakeup':
+                    self._drain_wakeup()
+                else:
+                    client = key.data
+                    try:
+                        if mask & selectors.EVENT_READ:
+                            self._read(client)
+                        if mask & selectors.EVENT_WRITE and not client.closing:
+                            self._flush(client)
+                    except Exception as e:
+                        # One misbehaving client must not stop delivery to all the others.
+                        print(f"[Event stream] Dropping client {client.address}: {e}")
+                        self._close(client)
+
+            self._dispatch_pending()
+
+            if time.monotonic() >= next_keepalive:
+                # Comment lines and pings keep proxies and browsers from timing out idle streams.
+                for client in list(self.clients.values()):
+                    if client.protocol == 'sse':
+                        self._send(client, b': keepalive\n\n')
+                    elif client.protocol == 'ws' and not client.outbuf:
+                        self._send(client, websocket_frame(0x9, b''))
+                next_keepalive = time.monotonic() + KEEPALIVE_SECONDS
+
+        for client in list(self.clients.values()):
+            self._close(client)
+        self.selector.close()
+        self.listener.close()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            sock.setblocking(False)
+            client = StreamClient(sock, address)
+            with self.clients_lock:
+                self.clients[sock.fileno()] = client
+            self.selector.register(sock, selectors.EVENT_READ, client)
+
+    def _drain_wakeup(self):
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _read(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._close(client)
+            return
+        if client.protocol == 'sse' or client.close_when_flushed:
+            # Browsers send nothing after the request; ignore anything that arrives.
+            return
+
+        client.inbuf += data
+        if client.protocol == 'ws':
+            self._read_websocket(client)
+            return
+        if b'\r\n\r\n' in client.inbuf:
+            self._handle_request(client)
+        elif len(client.inbuf) > MAX_REQUEST_BYTES:
+            self._reject(client, b'431 Request Header Fields Too Large')
+
+    def _handle_request(self, client):
+        head = bytes(client.inbuf).split(b'\r\n\r\n', 1)[0].decode('latin-1')
+        lines = head.split('\r\n')
+        try:
+            method, target, _ = lines[0].split(' ', 2)
+        except ValueError:
+            self._reject(client, b'400 Bad Request')
+            return
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        url = urlsplit(target)
+        if method != 'GET' or url.path not in ('/api/stream', '/ws'):
+            self._reject(client, b'404 Not Found')
+            return
+
+        query = parse_qs(url.query)
+        filters = []
+        for value in query.get('topics', []):
+            filters.extend(t for t in value.split(',') if t)
+        for value in query.get('devices', []):
+            filters.extend(f"device/{d}" for d in value.split(',') if d)
+        client.filters = filters
+
+        if url.path == '/ws':
+            self._accept_websocket(client, headers)
+            return
+
+        client.protocol = 'sse'
+        client.inbuf.clear()
+        self._send(client, b'HTTP/1.1 200 OK\r\n'
+                           b'Content-Type: text/event-stream\r\n'
+                           b'Cache-Control: no-cache\r\n'
+                           b'Connection: keep-alive\r\n'
+                           b'Access-Control-Allow-Origin: *\r\n'
+                           b'\r\n'
+                           b'retry: 3000\n\n')
+
+        # A reconnecting EventSource sends the id of the last event it saw; replay what it missed.
+        last_id = headers.get('last-event-id') or (query.get('lastEventId') or [None])[0]
+        if last_id and last_id.isdigit():
+            for sequence, topic, frame in self.recent:
+                if sequence > int(last_id) and client.wants(topic):
+                    self._send(client, frame)
+
+    def _accept_websocket(self, client, headers):
+        key = headers.get('sec-websocket-key')
+        if headers.get('upgrade', '').lower() != 'websocket' or not key:
+            self._reject(client, b'400 Bad Request')
+            return
+
+        accept = base64.b64encode(hashlib.sha1(key.encode('latin-1') + WS_GUID).digest())
+        client.protocol = 'ws'
+        client.inbuf = client.inbuf.split(b'\r\n\r\n', 1)[1]
+        self._send(client, b'HTTP/1.1 101 Switching Protocols\r\n'
+                           b'Upgrade: websocket\r\n'
+                           b'Connection: Upgrade\r\n'
+                           b'Sec-WebSocket-Accept: ' + accept + b'\r\n'
+                           b'\r\n')
+        if client.inbuf:
+            self._read_websocket(client)
+
+    def _read_websocket(self, client):
+        while not client.closing:
+            try:
+                frame = parse_websocket_frame(client.inbuf)
+            except ValueError:
+                self._send(client, websocket_frame(0x8, struct.pack('!H', 1009)))
+                self._close(client)
+                return
+            if frame is None:
+                return
+            fin, opcode, payload, consumed = frame
+            del client.inbuf[:consumed]
+
+            if opcode == 0x8:
+                self._send(client, websocket_frame(0x8, payload[:2]))
+                self._close(client)
+            elif opcode == 0x9:
+                self._send(client, websocket_frame(0xA, payload))
+            elif opcode in (0x0, 0x1, 0x2):
+                client.message += payload
+                if len(client.message) > MAX_WS_MESSAGE_BYTES:
+                    self._close(client)
+                elif fin:
+                    self._handle_websocket_message(client, bytes(client.message))
+                    client.message.clear()
+
+    def _handle_websocket_message(self, client, message):
+        """
+        Apply a {"subscribe": [...], "unsubscribe": [...]} filter update from a WebSocket client.
+        """
+        try:
+            request = json.loads(message.decode('utf-8'))
+        except ValueError:
+            return
+        if not isinstance(request, dict):
+            return
+        unsubscribe, subscribe = request.get('unsubscribe', []), request.get('subscribe', [])
+        for filters in (unsubscribe, subscribe):
+            if not isinstance(filters, list) or not all(isinstance(topic_filter, str) for topic_filter in filters):
+                return
+        for topic_filter in unsubscribe:
+            if topic_filter in client.filters:
+                client.filters.remove(topic_filter)
+        for topic_filter in subscribe:
+            if topic_filter not in client.filters:
+                client.filters.append(topic_filter)
+        ack = json.dumps({'subscribed': client.filters}).encode('utf-8')
+        self._send(client, websocket_frame(0x1, ack))
+
+    def _dispatch_pending(self):
+        with self.pending_lock:
+            batch, self.pending = self.pending, deque()
+        for topic, payload in batch:
+            self.sequence += 1
+            self.events_published += 1
+            data = json.dumps({'topic': topic, 'data': payload})
+            frame = f"id: {self.sequence}\nevent: update\ndata: {data}\n\n".encode('utf-8')
+            self.recent.append((self.sequence, topic, frame))
+            ws_frame = None
+            for client in list(self.clients.values()):
+                if client.protocol is None or not client.wants(topic):
+                    continue
+                if client.protocol == 'sse':
+                    self._send(client, frame)
+                    continue
+
+                if ws_frame is None:
+                    ws_frame = websocket_frame(0x1, data.encode('utf-8'))
+                if client.outbuf or client.coalesced:
+                    # Backed up: keep only the newest value per topic until the socket drains.
+                    if topic in client.coalesced:
+                        self.updates_coalesced += 1
+                    client.coalesced[topic] = ws_frame
+                    client.coalesced.move_to_end(topic)
+                else:
+                    self._send(client, ws_frame)
+
+    def _send(self, client, data):
+        if client.closing:
+            return
+        client.outbuf += data
+        if len(client.outbuf) > MAX_CLIENT_BUFFER:
+            # The client is not reading; drop it rather than buffering without bound.
+            self.clients_dropped += 1
+            self._close(client)
+            return
+        self._flush(client)
+
+    def _flush(self, client):
+        try:
+            sent = client.sock.send(client.outbuf)
+            del client.outbuf[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self._close(client)
+            return
+
+        if not client.outbuf and client.coalesced:
+            client.outbuf += b''.join(client.coalesced.values())
+            client.coalesced.clear()
+
+        if not client.outbuf and client.close_when_flushed:
+            self._close(client)
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.outbuf else 0)
+        self.selector.modify(client.sock, events, client)
+
+    def _reject(self, client, status):
+        client.outbuf += b'HTTP/1.1 ' + status + b'\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+        client.close_when_flushed = True
+        self._flush(client)
+
+    def _close(self, client):
+        client.closing = True
+        with self.clients_lock:
+            if self.clients.pop(client.sock.fileno(), None) is None:
+                return
+        try:
+            self.selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        client.sock.close()
@@ -0,0 +1,230 @@
+"""
+Generate large history databases with the backend's table schemas for benchmarking.
+
+A virtual clock steps through --days of readings at --interval seconds per series, with
+daily cycles and slow drift instead of uniform noise. Rows are written with executemany
+in large transactions and journalling off, so hundreds of millions of rows take minutes.
+
+    python generate_history.py --days 30 --out-dir synthetic
+    python generate_history.py --days 3650 --interval 1 --series temperature,aircon --index --jobs 2
+"""
+import argparse
+import datetime
+import math
+import os
+import random
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# series: (database file, table, CREATE TABLE statement, insert columns)
+SCHEMAS = {
+    'temperature': ('temperature.db', 'temperature_data', '''
+        CREATE TABLE IF NOT EXISTS temperature_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            value REAL,
+            timestamp TEXT
+        )''', ('value', 'timestamp')),
+    'water_heater': ('water_heater.db', 'water_heater_data', '''
+        CREATE TABLE IF NOT EXISTS water_heater_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            temperature REAL,
+            status TEXT,
+            timestamp TEXT
+        )''', ('temperature', 'status', 'timestamp')),
+    'light_control': ('light_control.db', 'light_control_data', '''
+        CREATE TABLE IF NOT EXISTS light_control_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            intensity REAL,
+            status TEXT,
+            timestamp TEXT
+        )''', ('intensity', 'status', 'timestamp')),
+    'fps': ('fps.db', 'fps_data', '''
+        CREATE TABLE IF NOT EXISTS fps_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fps REAL,
+            timestamp TEXT
+        )''', ('fps', 'timestamp')),
+    'aircon': ('aircon.db', 'aircon_data', '''
+        CREATE TABLE IF NOT EXISTS aircon_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            temperature REAL,
+            humidity REAL,
+            cooling_status TEXT,
+            dehumidifying_status TEXT,
+            timestamp TEXT
+        )''', ('temperature', 'humidity', 'cooling_status', 'dehumidifying_status', 'timestamp'))
+}
+
+# "HH:MM:SS" for every second of a day, so timestamps are built without strftime per row.
+CLOCK = [f"{second // 3600:02d}:{second // 60 % 60:02d}:{second % 60:02d}" for second in range(86400)]
+
+
+def daily_cycle(second_of_day, peak_hour=15):
+    """
+    -1 .. 1, peaking at peak_hour.
+    """
+    return math.cos((second_of_day / 3600 - peak_hour) / 24 * 2 * math.pi)
+
+
+class Drift:
+    """
+    Bounded random walk for slow weather-like changes over days.
+    """
+
+    def __init__(self, rng, step, limit):
+        self.rng = rng
+        self.step = step
+        self.limit = limit
+        self.value = 0.0
+
+    def next(self):
+        self.value = max(-self.limit, min(self.limit, self.value + self.rng.uniform(-self.step, self.step)))
+        return self.value
+
+
+def temperature_rows(rng):
+    drift = Drift(rng, 0.02, 3.0)
+
+    def row(second_of_day):
+        return (round(25.0 + 3.5 * daily_cycle(second_of_day) + drift.next() + rng.uniform(-0.3, 0.3), 2),)
+    return row
+
+
+def water_heater_rows(rng):
+    state = {'temperature': 45.0, 'running': True}
+
+    def row(second_of_day):
+        # Heats to 60 while running and cools to 35 while stopped.
+        if state['running']:
+            state['temperature'] += rng.uniform(0.05, 0.25)
+            if state['temperature'] >= 60.0:
+                state['running'] = False
+        else:
+            state['temperature'] -= rng.uniform(0.01, 0.08)
+            if state['temperature'] <= 35.0:
+                state['running'] = True
+        return round(state['temperature'], 2), 'running' if state['running'] else 'stopped'
+    return row
+
+
+def light_control_rows(rng):
+    def row(second_of_day):
+        daylight = max(0.0, daily_cycle(second_of_day, peak_hour=13))
+        intensity = round(100.0 + 700.0 * daylight + rng.uniform(-30.0, 30.0), 2)
+        intensity = min(800.0, max(100.0, intensity))
+        return intensity, "on" if intensity < 200.0 or intensity > 600.0 else "off"
+    return row
+
+
+def fps_rows(rng):
+    def row(second_of_day):
+        # Frame rate dips now and then, as when the camera is busy.
+        fps = rng.uniform(20.0, 35.0) if rng.random() < 0.02 else rng.uniform(50.0, 60.0)
+        return (round(fps, 2),)
+    return row
+
+
+def aircon_rows(rng):
+    drift = Drift(rng, 0.02, 4.0)
+    humidity_drift = Drift(rng, 0.05, 10.0)
+
+    def row(second_of_day):
+        cycle = daily_cycle(second_of_day)
+        temperature = round(27.0 + 5.0 * cycle + drift.next() + rng.uniform(-0.2, 0.2), 1)
+        humidity = round(min(95.0, max(30.0, 60.0 - 10.0 * cycle + humidity_drift.next() + rng.uniform(-1, 1))), 1)
+        return (temperature, humidity, "ON" if temperature > 28 else "OFF", "ON" if humidity > 65 else "OFF")
+    return row
+
+
+GENERATORS = {
+    'temperature': temperature_rows,
+    'water_heater': water_heater_rows,
+    'light_control': light_control_rows,
+    'fps': fps_rows,
+    'aircon': aircon_rows
+}
+
+
+def generate(series, args, rng):
+    db, table, schema, columns = SCHEMAS[series]
+    conn = sqlite3.connect(os.path.join(args.out_dir, db), isolation_level=None)
+    # Throwaway benchmark data: trade durability for write speed.
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('PRAGMA cache_size=-200000')
+    conn.execute(schema)
+    insert = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+
+    start = datetime.datetime.strptime(args.start, "%Y-%m-%d")
+    total = int(args.days * 86400 / args.interval)
+    make_row = GENERATORS[series](rng)
+    day_prefixes = {}
+    written = 0
+    started = time.perf_counter()
+
+    def rows(count, offset):
+        for index in range(offset, offset + count):
+            # Virtual clock: no sleeping, timestamps come from the row index.
+            elapsed = index * args.interval
+            day, second_of_day = divmod(int(elapsed), 86400)
+            prefix = day_prefixes.get(day)
+            if prefix is None:
+                prefix = day_prefixes.setdefault(day, (start + datetime.timedelta(days=day)).strftime("%Y-%m-%d "))
+            yield make_row(second_of_day) + (prefix + CLOCK[second_of_day],)
+
+    while written < total:
+        count = min(args.batch, total - written)
+        conn.execute('BEGIN')
+        conn.executemany(insert, rows(count, written))
+        conn.execute('COMMIT')
+        written += count
+        if args.progress:
+            print(f"\r[{series}] {written:,}/{total:,} rows", end='', flush=True)
+
+    if args.index:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_timestamp ON {table} (timestamp)')
+    conn.close()
+    elapsed = time.perf_counter() - started
+    if args.progress:
+        print()
+    print(f"[{series}] {written:,} rows in {elapsed:.1f} s ({written / elapsed:,.0f} rows/s)")
+    return written
+
+
+def generate_series(series, args, index):
+    return generate(series, args, random.Random(args.seed + index))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic device history databases")
+    parser.add_argument('--out-dir', default='synthetic')
+    parser.add_argument('--series', help=f"comma-separated subset of {', '.join(SCHEMAS)}")
+    parser.add_argument('--start', default='2025-01-01', help="first day of the virtual clock (YYYY-MM-DD)")
+    parser.add_argument('--days', type=float, default=30.0)
+    parser.add_argument('--interval', type=float, default=5.0, help="seconds between readings, as the simulators")
+    parser.add_argument('--batch', type=int, default=200000, help="rows per transaction")
+    parser.add_argument('--index', action='store_true', help="add a timestamp index to every table")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--jobs', type=int, default=1, help="series generated in parallel, one process each")
+    parser.add_argument('--progress', action='store_true')
+    args = parser.parse_args()
+
+    series = args.series.split(',') if args.series else list(SCHEMAS)
+    for name in series:
+        if name not in SCHEMAS:
+            parser.error(f"Unknown series '{name}', expected one of {', '.join(SCHEMAS)}")
+    if os.path.abspath(args.out_dir) == os.path.dirname(os.path.abspath(__file__)):
+        parser.error("Refusing to write synthetic rows into the live databases; choose another --out-dir")
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    started = time.perf_counter()
+    # Every series has its own database file, so they can be written in parallel.
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        total = sum(pool.map(generate_series, series, [args] * len(series), range(len(series))))
+    elapsed = time.perf_counter() - started
+    print(f"{total:,} rows in {elapsed:.1f} s ({total / elapsed:,.0f} rows/s) written to {args.out_dir}")
+
+
+if __name__ == '__main__':
+    main()
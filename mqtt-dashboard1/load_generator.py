@@ -0,0 +1,260 @@
+"""
+Simulate a fleet of virtual devices from one event loop over a small pool of MQTT connections.
+
+Each virtual device publishes the same payloads as the simulate_* functions of the backend
+on its own schedule. Schedules live in one heap, so thousands of devices cost no threads.
+
+    python load_generator.py --devices 5000 --interval 5 --connections 8 --duration 60
+    python load_generator.py --mix aircon=2,fps=1 --jitter 0.5 --format compact --json
+"""
+import argparse
+import asyncio
+import datetime
+import heapq
+import json
+import random
+import time
+
+import mqtt_wire
+
+DEFAULT_HOME_ID = 'default'
+
+
+def temperature_reading():
+    return {"temperature": round(random.uniform(20.0, 30.0), 2)}
+
+
+def water_heater_reading():
+    return {"temperature": round(random.uniform(30.0, 60.0), 2), "status": random.choice(['running', 'stopped'])}
+
+
+def light_control_reading():
+    intensity = round(random.uniform(100.0, 800.0), 2)
+    return {"intensity": intensity, "status": "on" if intensity < 200.0 or intensity > 600.0 else "off"}
+
+
+def aircon_reading():
+    temperature = round(random.uniform(22.0, 35.0), 1)
+    humidity = round(random.uniform(40.0, 80.0), 1)
+    return {
+        "temperature": temperature,
+        "humidity": humidity,
+        "cooling_status": "ON" if temperature > 28 else "OFF",
+        "dehumidifying_status": "ON" if humidity > 65 else "OFF"
+    }
+
+
+def fps_reading():
+    return {"fps": round(random.uniform(20.0, 60.0), 2)}
+
+
+def surveillance_camera_reading():
+    return {"status": random.choice(['recording', 'idle'])}
+
+
+DEVICE_TYPES = {
+    'temperature': temperature_reading,
+    'water_heater': water_heater_reading,
+    'light_control': light_control_reading,
+    'aircon': aircon_reading,
+    'fps': fps_reading,
+    'surveillance_camera': surveillance_camera_reading
+}
+
+PAYLOAD_FORMATS = {
+    'json': json.dumps,
+    'compact': lambda reading: json.dumps(reading, separators=(',', ':'))
+}
+
+
+def parse_mix(mix):
+    """
+    Turn "aircon=2,fps=1" into a list of device types weighted by their share.
+    """
+    if not mix:
+        return list(DEVICE_TYPES)
+    weighted = []
+    for entry in mix.split(','):
+        name, _, weight = entry.partition('=')
+        if name not in DEVICE_TYPES:
+            raise SystemExit(f"Unknown device type '{name}', expected one of {', '.join(DEVICE_TYPES)}")
+        weighted.extend([name] * int(weight or 1))
+    return weighted
+
+
+def device_topic(home_id, device_type):
+    if home_id == DEFAULT_HOME_ID:
+        return f"device/{device_type}"
+    return f"home/{home_id}/device/{device_type}"
+
+
+class Connection:
+    def __init__(self, index, qos):
+        self.index = index
+        self.qos = qos
+        self.reader = None
+        self.writer = None
+        self.next_packet_id = 0
+        self.acked = 0
+        self.tasks = []
+
+    async def open(self, host, port, keepalive):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(mqtt_wire.connect_packet(f"load-generator-{self.index}-{random.getrandbits(32):08x}",
+                                                   keepalive))
+        packet_type, _, body = await mqtt_wire.read_packet(self.reader)
+        if packet_type != mqtt_wire.CONNACK or body[1] != 0:
+            raise ConnectionError(f"Connection {self.index} refused by the broker")
+        self.tasks = [asyncio.create_task(self._read()), asyncio.create_task(self._ping(keepalive))]
+
+    async def _read(self):
+        try:
+            while True:
+                packet_type, _, _ = await mqtt_wire.read_packet(self.reader)
+                if packet_type == mqtt_wire.PUBACK:
+                    self.acked += 1
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    async def _ping(self, keepalive):
+        while True:
+            await asyncio.sleep(keepalive / 2)
+            self.writer.write(mqtt_wire.PINGREQ_PACKET)
+
+    def publish(self, topic, payload):
+        packet_id = None
+        if self.qos:
+            self.next_packet_id = self.next_packet_id % 65535 + 1
+            packet_id = self.next_packet_id
+        data = mqtt_wire.publish_packet(topic, payload, self.qos, packet_id=packet_id)
+        self.writer.write(data)
+        return len(data)
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.writer.write(mqtt_wire.DISCONNECT_PACKET)
+        await self.writer.drain()
+        self.writer.close()
+
+
+async def run(args):
+    types = parse_mix(args.mix)
+    encode = PAYLOAD_FORMATS[args.format]
+    devices = []
+    for index in range(args.devices):
+        home_id = DEFAULT_HOME_ID if index % args.homes == 0 else f"home{index % args.homes}"
+        device_type = types[index % len(types)]
+        devices.append((device_topic(home_id, device_type), DEVICE_TYPES[device_type]))
+
+    connections = [Connection(index, args.qos) for index in range(args.connections)]
+    for connection in connections:
+        await connection.open(args.host, args.port, args.keepalive)
+
+    start = time.monotonic()
+    end = start + args.duration
+    # Spread the first reading of every device over one interval so the load starts evenly.
+    schedule = [(start + random.uniform(0, args.interval), index) for index in range(args.devices)]
+    heapq.heapify(schedule)
+
+    sent = 0
+    sent_bytes = 0
+    max_lag = 0.0
+    last_report = start
+    last_report_sent = 0
+    timestamp_second = None
+    timestamp = None
+
+    while schedule:
+        now = time.monotonic()
+        if now >= end:
+            break
+        due_at = schedule[0][0]
+        if due_at > now:
+            await asyncio.sleep(min(due_at, end) - now)
+            continue
+
+        touched = set()
+        written = 0
+        while schedule and schedule[0][0] <= now and written < args.batch:
+            due_at, index = heapq.heappop(schedule)
+            written += 1
+            max_lag = max(max_lag, now - due_at)
+            # Formatting the wall clock once per second is much cheaper than once per message.
+            second = int(time.time())
+            if second != timestamp_second:
+                timestamp_second = second
+                timestamp = datetime.datetime.fromtimestamp(second).strftime("%Y-%m-%d %H:%M:%S")
+            topic, reading = devices[index]
+            payload = reading()
+            payload['timestamp'] = timestamp
+            connection = connections[index % len(connections)]
+            sent_bytes += connection.publish(topic, encode(payload))
+            sent += 1
+            touched.add(connection)
+            jitter = random.uniform(-args.jitter, args.jitter) if args.jitter else 0.0
+            heapq.heappush(schedule, (due_at + args.interval * (1 + jitter), index))
+        for connection in touched:
+            await connection.writer.drain()
+
+        if args.report_every and now - last_report >= args.report_every:
+            rate = (sent - last_report_sent) / (now - last_report)
+            print(f"[Load] {sent} messages, {rate:.0f} msg/s, lag {max_lag * 1000:.1f} ms")
+            last_report, last_report_sent = now, sent
+
+    elapsed = time.monotonic() - start
+    await asyncio.sleep(0.2 if args.qos else 0)
+    for connection in connections:
+        await connection.close()
+
+    return {
+        'devices': args.devices,
+        'connections': args.connections,
+        'qos': args.qos,
+        'format': args.format,
+        'duration_s': round(elapsed, 2),
+        'sent': sent,
+        'acked': sum(connection.acked for connection in connections) if args.qos else None,
+        'bytes': sent_bytes,
+        'target_msgs_per_s': round(args.devices / args.interval, 1),
+        'achieved_msgs_per_s': round(sent / elapsed, 1) if elapsed else 0.0,
+        'max_schedule_lag_ms': round(max_lag * 1000, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Virtual device fleet load generator")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=1884)
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--interval', type=float, default=5.0, help="seconds between readings of one device")
+    parser.add_argument('--jitter', type=float, default=0.1, help="relative jitter of the interval, 0 to 1")
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--connections', type=int, default=4)
+    parser.add_argument('--homes', type=int, default=1, help="spread devices over this many homes")
+    parser.add_argument('--mix', help="device type weights, e.g. aircon=2,fps=1 (default: all types)")
+    parser.add_argument('--format', choices=sorted(PAYLOAD_FORMATS), default='json')
+    parser.add_argument('--qos', type=int, choices=(0, 1), default=0)
+    parser.add_argument('--keepalive', type=int, default=60)
+    parser.add_argument('--batch', type=int, default=500, help="messages written before yielding to the loop")
+    parser.add_argument('--report-every', type=float, default=5.0)
+    parser.add_argument('--json', action='store_true', help="print the summary as JSON")
+    args = parser.parse_args()
+    for name in ('devices', 'connections', 'homes', 'batch'):
+        if getattr(args, name) < 1:
+            parser.error(f"--{name} must be at least 1")
+    if args.interval <= 0:
+        parser.error("--interval must be positive")
+    if not 0 <= args.jitter <= 1:
+        parser.error("--jitter must be between 0 and 1")
+
+    summary = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(summary))
+    else:
+        for key, value in summary.items():
+            print(f"{key:<22}{value}")
+
+
+if __name__ == '__main__':
+    main()
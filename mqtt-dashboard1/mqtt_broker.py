@@ -0,0 +1,229 @@
+"""
+Small in-process MQTT 3.1.1 broker for tests, benchmarks and machines without Mosquitto.
+
+Supports publish/subscribe with '+' and '#' wildcards, QoS 0 and 1, retained messages
+and keepalive. Sessions are always clean and QoS 1 deliveries are not retransmitted,
+which is enough for a single host where TCP does not lose messages.
+
+    broker = MQTTBroker(port=0)        # 0 picks a free port
+    port = broker.start()
+    ...
+    broker.stop()
+
+    python mqtt_broker.py --port 1884
+"""
+import argparse
+import asyncio
+import sys
+import threading
+
+import mqtt_wire
+from event_stream import topic_matches
+
+
+class BrokerClient:
+    def __init__(self, writer):
+        self.writer = writer
+        self.client_id = None
+        # topic filter -> granted QoS
+        self.subscriptions = {}
+        self.next_packet_id = 0
+
+    def send(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    def deliver(self, topic, payload, qos, retain=False):
+        packet_id = None
+        if qos:
+            self.next_packet_id = self.next_packet_id % 65535 + 1
+            packet_id = self.next_packet_id
+        self.send(mqtt_wire.publish_packet(topic, payload, qos, retain, packet_id))
+
+
+class MQTTBroker:
+    def __init__(self, host='127.0.0.1', port=1884):
+        self.host = host
+        self.port = port
+        self.clients = set()
+        # Exact topic filters are matched with a dict lookup; only wildcard filters are scanned.
+        self.exact = {}
+        self.wildcards = {}
+        self.retained = {}
+        # handler task -> its connection's writer
+        self.handlers = {}
+        self.messages_in = 0
+        self.messages_out = 0
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.ready = threading.Event()
+        # Why the broker could not start, re-raised by start().
+        self.error = None
+
+    def start(self):
+        """
+        Run the broker on a background thread. Return the port it listens on.
+        Raise OSError when it cannot listen, e.g. because Mosquitto already holds the port.
+        """
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+        return self.port
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            self.server = loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+            self.port = self.server.sockets[0].getsockname()[1]
+        except Exception as e:
+            print(f"[Broker] Cannot listen on {self.host}:{self.port}: {e}")
+            self.error = e
+            loop.close()
+            return
+        finally:
+            self.ready.set()
+        self.loop = loop
+        print(f"[Broker] Listening on {self.host}:{self.port}")
+        self.loop.run_forever()
+
+    def stop(self):
+        if self.loop is None:
+            return
+
+        async def shutdown():
+            self.server.close()
+            # Closing the sockets ends every handler's read loop, so they finish on their own.
+            for writer in self.handlers.values():
+                writer.close()
+            await asyncio.gather(*self.handlers, return_exceptions=True)
+            await self.server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result(timeout=2)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=2)
+
+    def stats(self):
+        return {
+            'clients': len(self.clients),
+            'subscriptions': sum(len(client.subscriptions) for client in self.clients),
+            'retained': len(self.retained),
+            'messages_in': self.messages_in,
+            'messages_out': self.messages_out
+        }
+
+    async def _handle(self, reader, writer):
+        client = BrokerClient(writer)
+        keepalive = None
+        handler = asyncio.current_task()
+        self.handlers[handler] = writer
+        try:
+            packet_type, _, body = await asyncio.wait_for(mqtt_wire.read_packet(reader), timeout=10)
+            if packet_type != mqtt_wire.CONNECT:
+                return
+            client.client_id, keepalive, _ = mqtt_wire.parse_connect(body)
+            self.clients.add(client)
+            client.send(mqtt_wire.connack_packet())
+
+            while True:
+                # The spec allows one and a half keepalive periods without any packet.
+                read = mqtt_wire.read_packet(reader)
+                packet_type, flags, body = await (asyncio.wait_for(read, keepalive * 1.5) if keepalive else read)
+                if packet_type == mqtt_wire.PUBLISH:
+                    topic, payload, qos, retain, packet_id = mqtt_wire.parse_publish(flags, body)
+                    if qos == 1:
+                        client.send(mqtt_wire.puback_packet(packet_id))
+                    self._route(topic, payload, qos, retain)
+                elif packet_type == mqtt_wire.SUBSCRIBE:
+                    packet_id, topics = mqtt_wire.parse_subscribe(body)
+                    granted = [self._subscribe(client, topic_filter, min(qos, 1)) for topic_filter, qos in topics]
+                    client.send(mqtt_wire.suback_packet(packet_id, granted))
+                    for topic_filter, _ in topics:
+                        self._send_retained(client, topic_filter)
+                elif packet_type == mqtt_wire.UNSUBSCRIBE:
+                    packet_id, topics = mqtt_wire.parse_unsubscribe(body)
+                    for topic_filter in topics:
+                        self._unsubscribe(client, topic_filter)
+                    client.send(mqtt_wire.unsuback_packet(packet_id))
+                elif packet_type == mqtt_wire.PINGREQ:
+                    client.send(mqtt_wire.PINGRESP_PACKET)
+                elif packet_type == mqtt_wire.DISCONNECT:
+                    break
+                # PUBACKs for our QoS 1 deliveries need no action without retransmission.
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, mqtt_wire.ProtocolError):
+            # Malformed packets arrive as ProtocolError from mqtt_wire and just end the connection.
+            pass
+        finally:
+            for topic_filter in list(client.subscriptions):
+                self._unsubscribe(client, topic_filter)
+            self.clients.discard(client)
+            self.handlers.pop(handler, None)
+            writer.close()
+
+    def _subscribe(self, client, topic_filter, qos):
+        client.subscriptions[topic_filter] = qos
+        index = self.wildcards if '+' in topic_filter or '#' in topic_filter else self.exact
+        index.setdefault(topic_filter, set()).add(client)
+        return qos
+
+    def _unsubscribe(self, client, topic_filter):
+        if client.subscriptions.pop(topic_filter, None) is None:
+            return
+        index = self.wildcards if '+' in topic_filter or '#' in topic_filter else self.exact
+        subscribers = index.get(topic_filter)
+        if subscribers is not None:
+            subscribers.discard(client)
+            if not subscribers:
+                del index[topic_filter]
+
+    def _route(self, topic, payload, qos, retain):
+        self.messages_in += 1
+        if retain:
+            # An empty retained payload clears the topic's retained message.
+            if payload:
+                self.retained[topic] = (payload, qos)
+            else:
+                self.retained.pop(topic, None)
+
+        # A client subscribed through several matching filters receives the message once, at the highest QoS.
+        targets = {}
+        for client in self.exact.get(topic, ()):
+            targets[client] = client.subscriptions[topic]
+        for topic_filter, subscribers in self.wildcards.items():
+            if topic_matches(topic_filter, topic):
+                for client in subscribers:
+                    targets[client] = max(targets.get(client, 0), client.subscriptions[topic_filter])
+        for client, granted in targets.items():
+            client.deliver(topic, payload, min(qos, granted))
+            self.messages_out += 1
+
+    def _send_retained(self, client, topic_filter):
+        for topic, (payload, qos) in self.retained.items():
+            if topic_matches(topic_filter, topic):
+                client.deliver(topic, payload, min(qos, client.subscriptions[topic_filter]), retain=True)
+                self.messages_out += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="In-process MQTT 3.1.1 broker")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1884)
+    args = parser.parse_args()
+
+    broker = MQTTBroker(args.host, args.port)
+    try:
+        broker.start()
+    except OSError:
+        sys.exit(1)
+    try:
+        broker.thread.join()
+    except KeyboardInterrupt:
+        broker.stop()
+
+
+if __name__ == '__main__':
+    main()
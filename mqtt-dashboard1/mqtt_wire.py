@@ -0,0 +1,202 @@
+"""
+Minimal MQTT 3.1.1 packet encoding and decoding shared by the load tools.
+
+Only what a QoS 0/1 publisher, subscriber or small broker needs is implemented:
+CONNECT/CONNACK, PUBLISH/PUBACK, SUBSCRIBE/SUBACK, UNSUBSCRIBE/UNSUBACK,
+PINGREQ/PINGRESP and DISCONNECT.
+"""
+import functools
+import struct
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def packet_parser(parse):
+    """
+    Report a truncated or undecodable packet body as ProtocolError.
+    """
+    @functools.wraps(parse)
+    def wrapper(*args):
+        try:
+            return parse(*args)
+        except (struct.error, IndexError, UnicodeDecodeError) as e:
+            raise ProtocolError(f"Malformed {parse.__name__[len('parse_'):]} packet: {e}")
+    return wrapper
+
+
+def encode_remaining_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value):
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return struct.pack('!H', len(value)) + value
+
+
+def decode_string(data, offset):
+    (length,) = struct.unpack_from('!H', data, offset)
+    start = offset + 2
+    if start + length > len(data):
+        raise ProtocolError("String runs past the end of the packet")
+    return data[start:start + length].decode('utf-8'), start + length
+
+
+def packet(packet_type, body=b'', flags=0):
+    return bytes([(packet_type << 4) | flags]) + encode_remaining_length(len(body)) + body
+
+
+def connect_packet(client_id, keepalive=60, clean_session=True):
+    flags = 0x02 if clean_session else 0
+    body = encode_string('MQTT') + bytes([4, flags]) + struct.pack('!H', keepalive) + encode_string(client_id)
+    return packet(CONNECT, body)
+
+
+def connack_packet(return_code=0, session_present=False):
+    return packet(CONNACK, bytes([1 if session_present else 0, return_code]))
+
+
+def publish_packet(topic, payload, qos=0, retain=False, packet_id=None, dup=False):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    flags = (0x08 if dup else 0) | (qos << 1) | (0x01 if retain else 0)
+    body = encode_string(topic)
+    if qos:
+        body += struct.pack('!H', packet_id)
+    return packet(PUBLISH, body + payload, flags)
+
+
+def puback_packet(packet_id):
+    return packet(PUBACK, struct.pack('!H', packet_id))
+
+
+def subscribe_packet(packet_id, topics):
+    """
+    `topics` is a list of (topic filter, requested QoS).
+    """
+    body = struct.pack('!H', packet_id)
+    for topic, qos in topics:
+        body += encode_string(topic) + bytes([qos])
+    return packet(SUBSCRIBE, body, 0x02)
+
+
+def suback_packet(packet_id, granted):
+    return packet(SUBACK, struct.pack('!H', packet_id) + bytes(granted))
+
+
+def unsubscribe_packet(packet_id, topics):
+    body = struct.pack('!H', packet_id)
+    for topic in topics:
+        body += encode_string(topic)
+    return packet(UNSUBSCRIBE, body, 0x02)
+
+
+def unsuback_packet(packet_id):
+    return packet(UNSUBACK, struct.pack('!H', packet_id))
+
+
+PINGREQ_PACKET = packet(PINGREQ)
+PINGRESP_PACKET = packet(PINGRESP)
+DISCONNECT_PACKET = packet(DISCONNECT)
+
+
+async def read_packet(reader):
+    """
+    Read one packet from an asyncio StreamReader. Return (type, flags, body).
+    Raise asyncio.IncompleteReadError when the connection closes.
+    """
+    header = await reader.readexactly(1)
+    length = 0
+    multiplier = 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+        if multiplier > 128 ** 3:
+            raise ProtocolError("Malformed remaining length")
+    body = await reader.readexactly(length) if length else b''
+    return header[0] >> 4, header[0] & 0x0F, body
+
+
+@packet_parser
+def parse_connect(body):
+    """
+    Return (client_id, keepalive, clean_session) of a CONNECT body.
+    """
+    protocol, offset = decode_string(body, 0)
+    if protocol not in ('MQTT', 'MQIsdp'):
+        raise ProtocolError(f"Unsupported protocol {protocol}")
+    flags = body[offset + 1]
+    (keepalive,) = struct.unpack_from('!H', body, offset + 2)
+    client_id, offset = decode_string(body, offset + 4)
+    return client_id, keepalive, bool(flags & 0x02)
+
+
+@packet_parser
+def parse_publish(flags, body):
+    """
+    Return (topic, payload, qos, retain, packet_id) of a PUBLISH packet.
+    """
+    qos = (flags >> 1) & 0x03
+    topic, offset = decode_string(body, 0)
+    packet_id = None
+    if qos:
+        (packet_id,) = struct.unpack_from('!H', body, offset)
+        offset += 2
+    return topic, body[offset:], qos, bool(flags & 0x01), packet_id
+
+
+@packet_parser
+def parse_subscribe(body):
+    """
+    Return (packet_id, [(topic filter, qos), ...]) of a SUBSCRIBE body.
+    """
+    (packet_id,) = struct.unpack_from('!H', body, 0)
+    offset = 2
+    topics = []
+    while offset < len(body):
+        topic, offset = decode_string(body, offset)
+        topics.append((topic, body[offset] & 0x03))
+        offset += 1
+    return packet_id, topics
+
+
+@packet_parser
+def parse_unsubscribe(body):
+    (packet_id,) = struct.unpack_from('!H', body, 0)
+    offset = 2
+    topics = []
+    while offset < len(body):
+        topic, offset = decode_string(body, offset)
+        topics.append(topic)
+    return packet_id, topics
+
+
+@packet_parser
+def parse_packet_id(body):
+    return struct.unpack_from('!H', body, 0)[0]
+
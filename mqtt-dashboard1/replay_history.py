@@ -0,0 +1,144 @@
+"""
+Replay stored history onto the original device/* topics in timestamp order.
+
+Rows of all selected series are merged by timestamp and published with their original
+inter-arrival gaps divided by --speed, so the same trace gives the same load every run.
+
+    python replay_history.py --speed 10
+    python replay_history.py --series aircon,fps --since "2025-06-01 00:00:00" --speed 1000 --max-gap 60
+"""
+import argparse
+import asyncio
+import datetime
+import heapq
+import json
+import sqlite3
+import time
+
+from load_generator import PAYLOAD_FORMATS, Connection
+
+# series: (database, table, payload fields in column order, topic)
+REPLAY_SOURCES = {
+    'temperature': ('temperature.db', 'temperature_data', ('temperature',), 'device/temperature'),
+    'water_heater': ('water_heater.db', 'water_heater_data', ('temperature', 'status'), 'device/water_heater'),
+    'light_control': ('light_control.db', 'light_control_data', ('intensity', 'status'), 'device/light_control'),
+    'fps': ('fps.db', 'fps_data', ('fps',), 'device/fps'),
+    'surveillance_camera': ('surveillance_camera.db', 'surveillance_camera_data', ('status',),
+                            'device/surveillance_camera'),
+    'aircon': ('aircon.db', 'aircon_data',
+               ('temperature', 'humidity', 'cooling_status', 'dehumidifying_status'), 'device/aircon')
+}
+# The temperature table stores the reading as `value`; the other tables use the payload names.
+SOURCE_COLUMNS = {'temperature': ('value',)}
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def read_series(series, since, until):
+    """
+    Yield (timestamp, series, payload) for one series in timestamp order.
+    """
+    db, table, fields, _ = REPLAY_SOURCES[series]
+    columns = SOURCE_COLUMNS.get(series, fields)
+    conn = sqlite3.connect(db)
+    try:
+        cursor = conn.execute(
+            f"SELECT timestamp, {', '.join(columns)} FROM {table} "
+            f"WHERE timestamp >= ? AND timestamp <= ? ORDER BY timestamp, id",
+            (since, until))
+        for row in cursor:
+            yield row[0], series, dict(zip(fields, row[1:]))
+    finally:
+        conn.close()
+
+
+async def replay(args):
+    series = args.series.split(',') if args.series else list(REPLAY_SOURCES)
+    for name in series:
+        if name not in REPLAY_SOURCES:
+            raise SystemExit(f"Unknown series '{name}', expected one of {', '.join(REPLAY_SOURCES)}")
+
+    encode = PAYLOAD_FORMATS[args.format]
+    connection = Connection(0, args.qos)
+    await connection.open(args.host, args.port, 60)
+
+    merged = heapq.merge(*(read_series(name, args.since, args.until) for name in series))
+    start = time.monotonic()
+    trace_start = None
+    trace_offset = 0.0
+    previous = None
+    sent = 0
+    per_series = {}
+    max_lag = 0.0
+
+    for timestamp, name, payload in merged:
+        moment = datetime.datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+        if trace_start is None:
+            trace_start = moment
+        if previous is not None:
+            gap = (moment - previous).total_seconds()
+            trace_offset += min(gap, args.max_gap) if args.max_gap is not None else gap
+        previous = moment
+
+        due = start + trace_offset / args.speed
+        delay = due - time.monotonic()
+        if delay > 0:
+            await connection.writer.drain()
+            await asyncio.sleep(delay)
+        else:
+            max_lag = max(max_lag, -delay)
+
+        if args.timestamps == 'now':
+            payload['timestamp'] = datetime.datetime.now().strftime(TIMESTAMP_FORMAT)
+        else:
+            payload['timestamp'] = timestamp
+        connection.publish(REPLAY_SOURCES[name][3], encode(payload))
+        sent += 1
+        per_series[name] = per_series.get(name, 0) + 1
+        if args.limit and sent >= args.limit:
+            break
+
+    await connection.writer.drain()
+    elapsed = time.monotonic() - start
+    await asyncio.sleep(0.2 if args.qos else 0)
+    await connection.close()
+
+    return {
+        'series': per_series,
+        'sent': sent,
+        'speed': args.speed,
+        'trace_seconds': round(trace_offset, 1),
+        'wall_seconds': round(elapsed, 2),
+        'achieved_speed': round(trace_offset / elapsed, 1) if elapsed else None,
+        'msgs_per_s': round(sent / elapsed, 1) if elapsed else None,
+        'max_lag_ms': round(max_lag * 1000, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay stored device history through MQTT")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=1884)
+    parser.add_argument('--series', help=f"comma-separated subset of {', '.join(REPLAY_SOURCES)}")
+    parser.add_argument('--since', default='0000-01-01 00:00:00')
+    parser.add_argument('--until', default='9999-12-31 23:59:59')
+    parser.add_argument('--speed', type=float, default=1.0, help="1 for real time, 10, 1000, ...")
+    parser.add_argument('--max-gap', type=float, help="cap gaps in the trace (e.g. downtime) to this many seconds")
+    parser.add_argument('--limit', type=int, help="stop after this many messages")
+    parser.add_argument('--timestamps', choices=('original', 'now'), default='original')
+    parser.add_argument('--format', choices=sorted(PAYLOAD_FORMATS), default='json')
+    parser.add_argument('--qos', type=int, choices=(0, 1), default=0)
+    parser.add_argument('--json', action='store_true', help="print the summary as JSON")
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+
+    summary = asyncio.run(replay(args))
+    if args.json:
+        print(json.dumps(summary))
+    else:
+        for key, value in summary.items():
+            print(f"{key:<16}{value}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Production server: several API worker processes on one listening socket, plus one ingest process.
+
+    python serve.py --workers 4 --port 5050
+    MQTT_EMBEDDED_BROKER=1 python serve.py --workers 8 --no-simulators
+
+The ingest process owns the MQTT subscription, the simulators, the scheduler, the rule engine
+and the push stream on port 5051. Workers answer HTTP requests with werkzeug's threaded server
+on the inherited socket, and the kernel spreads connections over them. Latest readings,
+realtime messages, table versions, device states, schedules and rules go through
+shared_state.py, so every worker answers with the same data; so do the statistics of the
+ingest process, the broker and each process's command latency, refreshed every second.
+Command coalescing and the outbound queue stay per worker. Workers that exit are restarted.
+Needs a Unix-like OS; on Windows run BackencodeEnglish.py directly.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+
+def load_backend(args, broker):
+    # Workers must not react to Ctrl+C themselves; the supervisor stops them.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import BackencodeEnglish as backend
+    from shared_state import SharedState
+
+    backend.use_shared_state(SharedState(args.shared_state))
+    backend.MQTT_BROKER_HOST, backend.MQTT_BROKER_PORT = broker
+    return backend
+
+
+def ingest_process(args, broker):
+    backend = load_backend(args, broker)
+    backend.start_services(simulators=args.simulators)
+    backend.publish_shared_stats({
+        'series': backend.stats_summary,
+        'stream': backend.event_stream.stats,
+        'commands:ingest': backend.command_tracker.latency_summary
+    })
+    while True:
+        time.sleep(3600)
+
+
+def worker_process(index, args, broker, listener):
+    backend = load_backend(args, broker)
+    from werkzeug.serving import make_server
+
+    if not args.access_log:
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    # Each worker drains its own queue, so a command queued while the broker was down is sent once.
+    backend.outbound_queue.db_path = f"outbound.worker{index}.db"
+    backend.init_outbound_db(backend.outbound_queue.db_path)
+    backend.device_scheduler.start(run=False)
+    backend.start_backend_client(f"backend-worker{index}", ingest=False)
+    backend.publish_shared_stats({f"commands:worker{index}": backend.command_tracker.latency_summary})
+    server = make_server(args.host, args.port, backend.app, threaded=True, fd=listener.fileno())
+    print(f"[Serve] Worker {index} (pid {os.getpid()}) ready")
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-process production server for the MQTT dashboard backend")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--shared-state', default='shared_state.db', help="file of the cross-process state store")
+    parser.add_argument('--no-simulators', dest='simulators', action='store_false',
+                        help="only ingest real devices")
+    parser.add_argument('--access-log', action='store_true', help="log every request")
+    args = parser.parse_args()
+    args.shared_state = os.path.abspath(args.shared_state)
+
+    import BackencodeEnglish as backend
+    from shared_state import SharedState
+
+    backend.init_databases()
+    # The state of a previous run is stale; this process seeds the new one before any worker starts.
+    backend.use_shared_state(SharedState(args.shared_state, reset=True))
+
+    if backend.MQTT_EMBEDDED_BROKER:
+        backend.start_embedded_broker()
+        backend.publish_shared_stats({'broker': backend.broker_stats})
+    broker = (backend.MQTT_BROKER_HOST, backend.MQTT_BROKER_PORT)
+
+    listener = socket.create_server((args.host, args.port), backlog=1024)
+    # Spawned processes import the backend afresh instead of inheriting this one's connections.
+    context = multiprocessing.get_context('spawn')
+    specs = [('ingest', ingest_process, (args, broker))]
+    specs += [(f"worker{index}", worker_process, (index, args, broker, listener)) for index in range(args.workers)]
+    processes = {}
+
+    def launch(name, target, target_args):
+        process = context.Process(target=target, args=target_args, name=name, daemon=True)
+        process.start()
+        processes[name] = process
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    for spec in specs:
+        launch(*spec)
+    print(f"[Serve] {args.workers} workers on http://{args.host}:{args.port}, broker {broker[0]}:{broker[1]}")
+    try:
+        while True:
+            time.sleep(1)
+            for name, target, target_args in specs:
+                if not processes[name].is_alive():
+                    print(f"[Serve] {name} exited with code {processes[name].exitcode}, restarting")
+                    launch(name, target, target_args)
+    except KeyboardInterrupt:
+        print("[Serve] Shutting down")
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join(timeout=5)
+        if backend.embedded_broker is not None:
+            backend.embedded_broker.stop()
+
+
+if __name__ == '__main__':
+    main()
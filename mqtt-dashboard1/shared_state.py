@@ -0,0 +1,120 @@
+"""
+Key-value store and counters in one SQLite file, shared by the processes of the production server.
+
+Values are JSON. The file runs in WAL mode, so readers in the workers do not wait for the
+ingest process's writes, and without fsync: the state is rebuilt from the databases and the
+live MQTT feed on every start, so losing it in a crash costs nothing.
+
+    store = SharedState('shared_state.db', reset=True)   # once, in the supervisor
+    store = SharedState('shared_state.db')               # in every worker
+    store.set('latest:fps', {'fps': 57.2})
+    store.incr('table:fps_data')
+"""
+import json
+import os
+import sqlite3
+import threading
+
+
+def prefix_range(prefix):
+    """
+    Bounds of the keys starting with prefix, for an index range scan.
+    """
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class SharedState:
+    def __init__(self, path, reset=False):
+        self.path = path
+        self.local = threading.local()
+        # Appends per key made by this process, to trim each list every so often.
+        self.appends = {}
+        if reset:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_log_key ON log (key, id)')
+
+    def _conn(self):
+        # One connection per thread and process; a connection inherited through fork is not reused.
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA synchronous=OFF')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def get(self, key, default=None):
+        row = self._conn().execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key, value, only_if_missing=False):
+        """
+        Store a value. With only_if_missing an existing value is kept. Return True when it was written.
+        """
+        verb = 'INSERT OR IGNORE' if only_if_missing else 'INSERT OR REPLACE'
+        cursor = self._conn().execute(f"{verb} INTO kv (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+        return cursor.rowcount > 0
+
+    def delete(self, key):
+        return self._conn().execute("DELETE FROM kv WHERE key = ?", (key,)).rowcount > 0
+
+    def items(self, prefix):
+        """
+        Return {key without prefix: value} for every key starting with prefix.
+        """
+        cursor = self._conn().execute("SELECT key, value FROM kv WHERE key >= ? AND key < ?", prefix_range(prefix))
+        return {key[len(prefix):]: json.loads(value) for key, value in cursor}
+
+    def incr(self, name, amount=1):
+        """
+        Add to a counter and return its new value, atomically across processes.
+        """
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute("INSERT INTO counters (name, value) VALUES (?, ?) "
+                         "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value", (name, amount))
+            value = conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()[0]
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return value
+
+    def counter(self, name):
+        row = self._conn().execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def append(self, key, value, keep):
+        """
+        Add a value to the list under key. Lists are trimmed now and then to about `keep` entries.
+        """
+        conn = self._conn()
+        conn.execute("INSERT INTO log (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+        appends = self.appends[key] = self.appends.get(key, 0) + 1
+        if appends % max(1, keep // 4) == 0:
+            row = conn.execute("SELECT id FROM log WHERE key = ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                               (key, keep)).fetchone()
+            if row:
+                conn.execute("DELETE FROM log WHERE key = ? AND id <= ?", (key, row[0]))
+
+    def recent(self, key, limit):
+        """
+        Return the newest `limit` values of the list under key, oldest first.
+        """
+        rows = self._conn().execute("SELECT value FROM log WHERE key = ? ORDER BY id DESC LIMIT ?",
+                                    (key, limit)).fetchall()
+        return [json.loads(value) for value, in reversed(rows)]